@@ -1,35 +1,88 @@
-from ultralytics import YOLO
-from torch import cuda 
+from modelregistry import get_model, resolve_model, model_lock
+from stitching import capture_order, stitch_cached, stitch_sequential
+import profiling
 from PIL import Image
 import cv2
 import numpy as np
 import glob
+import math
 import os
+import json
+from concurrent.futures import ThreadPoolExecutor
 
+try:
+    from scipy.spatial import Delaunay, cKDTree
+except ImportError:  # senza scipy l'interpolazione usa sempre i 3 centroidi più vicini
+    Delaunay = cKDTree = None
 
-def stitch_image(folder_path):
-    print("IMAGE STITCHING STARTING")
-    # Initialize SIFT detector for CPU
-    sift = cv2.SIFT_create()
 
-    # Load all images from a directory (assuming they are all in a directory 'stitch dataset/0108/')
-    image_files = glob.glob(folder_path + "/*")
-    images = []
-    #print(image_files)
-    # Load images
-    for image_file in image_files:
+def read_images(image_files, workers=4):
+    """
+    Decodifica le immagini a piena risoluzione in parallelo con un pool di thread (cv2.imread
+    rilascia il GIL). Le immagini non leggibili vengono saltate; restituisce le immagini e i file
+    corrispondenti, nell'ordine di `image_files`.
+    """
+    def read(image_file):
         print("reading image:", image_file)
-        img = cv2.imread(image_file)
+        return cv2.imread(image_file, cv2.IMREAD_COLOR)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        decoded = list(pool.map(read, image_files))
+
+    images = []
+    loaded_files = []
+    for image_file, img in zip(image_files, decoded):
         if img is None:
             print(f"Error loading image {image_file}")
             continue
         images.append(img)
+        loaded_files.append(image_file)
+    return images, loaded_files
+
+def stitch_image(folder_path, workers=4, registration_reduce=1, mode="opencv", registration_mp=0.6,
+                 compositing_mp=-1, feature_cache_dir=None, motion="affine"):
+    """
+    Mosaica le immagini della cartella. `workers` è il numero di thread di decodifica.
+    Con `registration_reduce` (2, 4, 8) le feature di "cached"/"sequential" vengono estratte da copie
+    decodificate dal JPEG a risoluzione ridotta, mentre il mosaico usa sempre i frame a piena
+    risoluzione (cv2.Stitcher riduce già da sé le immagini per la registrazione).
+    La registrazione avviene a `registration_mp` megapixel e la composizione a `compositing_mp`
+    (<= 0 = risoluzione nativa). `mode` è "opencv" (cv2.Stitcher), "cached"
+    (stitching.stitch_cached, con le feature salvate in `feature_cache_dir` e modello di moto
+    `motion`, "affine" o "homography") oppure "sequential" (stitching.stitch_sequential, solo
+    immagini consecutive nell'ordine di acquisizione). Se cv2.Stitcher fallisce si ripiega sullo
+    stitch sequenziale e solo dopo sull'affiancamento semplice.
+    Restituisce il mosaico come frame NumPy BGR (quello che ricevono le fasi successive) e il numero
+    di immagini lette.
+    """
+    print("IMAGE STITCHING STARTING")
 
-    print("preparing images stitcher...")
-    # Create a stitcher object
-    stitcher = cv2.createStitcher() if int(cv2.__version__.split('.')[0]) < 4 else cv2.Stitcher_create()
-    #stitcher.setPanoConfidenceThresh(0.4)
-    status, panorama = stitcher.stitch(images)
+    # Load all images from a directory (assuming they are all in a directory 'stitch dataset/0108/')
+    image_files = capture_order(glob.glob(folder_path + "/*"))
+    images, image_files = read_images(image_files, workers=workers)
+
+    feature_options = dict(registration_mp=registration_mp, compositing_mp=compositing_mp,
+                           cache_dir=feature_cache_dir, motion=motion,
+                           registration_reduce=registration_reduce, workers=workers)
+    if mode == "sequential":
+        print("stitching ordered sequence...")
+        panorama = stitch_sequential(images, image_files, **feature_options)
+    elif mode == "cached":
+        print("stitching with cached features...")
+        panorama = stitch_cached(images, image_files, **feature_options)
+    elif mode == "opencv":
+        print("preparing images stitcher...")
+        # Create a stitcher object
+        stitcher = cv2.createStitcher() if int(cv2.__version__.split('.')[0]) < 4 else cv2.Stitcher_create()
+        #stitcher.setPanoConfidenceThresh(0.4)
+        stitcher.setRegistrationResol(registration_mp)
+        stitcher.setCompositingResol(compositing_mp)
+        status, panorama = stitcher.stitch(images)
+        if panorama is None and len(images) > 1:
+            print("... stitcher failed, stitching ordered sequence ...")
+            panorama = stitch_sequential(images, image_files, **feature_options)
+    else:
+        raise ValueError(f"Unknown stitching mode: {mode}")
     print("... stitch done ...")
     if panorama is None:
         base_h = min(img.shape[0] for img in images)
@@ -50,86 +103,135 @@ def stitch_image(folder_path):
     # else:
     #     dimensioni = 0
 
-    print("... color adjustment ...")
-    img_rgb = cv2.cvtColor(panorama, cv2.COLOR_BGR2RGB)
-
-    # Converti l'immagine in un oggetto PIL
-    img_pil = Image.fromarray(img_rgb)
-    
     print("... IMAGE STITCHING DONE")
-    return img_pil, len(images)
+    return np.ascontiguousarray(panorama), len(images)
+
+
+def orangetree(image, model_path, confidence=0.1, batch_size=8, imgsz=None, min_object_px=32):
+    tree_image, _ = orangetree_bbox(image, model_path, confidence, batch_size=batch_size, imgsz=imgsz,
+                                    min_object_px=min_object_px)
+    return tree_image
 
+def crop_box(box):
+    # stesso arrotondamento di PIL Image.crop, per conoscere l'offset esatto del ritaglio
+    return tuple(int(round(v)) for v in box)
 
-def orangetree(image, model_path, confidence=0.1):
+def orangetree_bbox(image, model_path, confidence=0.1, batch_size=8, imgsz=None, min_object_px=32):
+    """
+    Come orangetree, ma restituisce anche il riquadro (left, top, right, bottom) in pixel interi
+    del ritaglio nell'immagine di partenza. `model_path` può essere anche un modello già caricato.
+    La seconda predizione (alberi dentro ogni candidato) gira a batch sui candidati in ordine di
+    area decrescente: quelli la cui box esterna non può superare l'area migliore trovata vengono scartati.
+    `imgsz` (intero, None o "auto") vale per entrambe le fasi, vedi stage_imgsz.
+    L'albero restituito è una vista del frame BGR dell'immagine (convertita solo se PIL).
+    """
     print("TREE DETECTION STARTING")
-    model = YOLO(model_path)
-    if cuda.is_available():
-        print("...switching model to cuda")
-        model.to('cuda')
-    c = model.predict(source=image, conf=confidence, save=False,verbose=False) 
+    model = resolve_model(model_path)
+    frame = to_frame(image)
+    img_width, img_height = image_size(frame)
+    c = predict_tiles(model, [frame], conf=confidence,
+                      imgsz=stage_imgsz(imgsz, max(img_width, img_height), min_object_px=min_object_px))
     if len(c[0].boxes) == 0:
-        w, h = image.size
+        w, h = img_width, img_height
         center_left   = int(w * 0.25)
         center_top    = int(h * 0.15)
         center_right  = int(w * 0.75)
         center_bottom = int(h * 0.85)
         print("... TREE DETECTION DONE")
 
-        return image.crop((center_left, center_top, center_right, center_bottom))
-    
-    #image = Image.open(image_path)
-    img_width, img_height = image.size
-
-    # Variabili per tracciare la bounding box più grande e la relativa immagine ritagliata
-    max_area = 0
-    tree = None
-    bboxp = None
-    area = 0  # Area iniziale impostata a zero
+        box = (center_left, center_top, center_right, center_bottom)
+        return crop_region(frame, box), box
 
-    # Itera attraverso ogni risultato di predizione
+    # candidati della prima fase: (box esterna, area del suo ritaglio, ordine di rilevazione)
+    candidates = []
     for result in c:
         for bbox in result.boxes.xyxy:
-            # Estrai le coordinate (left, top, right, bottom) dalla bounding box
             left, top, right, bottom = bbox.tolist()
+            l, t, r, b = crop_box((left, top, right, bottom))
+            candidates.append(((left, top, right, bottom), (r - l) * (b - t), len(candidates)))
+    # un albero interno non può essere più grande del ritaglio che lo contiene
+    candidates.sort(key=lambda cand: -cand[1])
 
-            # Taglia l'immagine secondo la bounding box
-            cropped_image = image.crop((left, top, right, bottom))
-            
-            # Seconda predizione sul ritaglio
-            d = model.predict(source=cropped_image, conf=confidence, save=False)
-            
-            for result in d:
-                for bbox in result.boxes.xyxy:
-                    # Estrai le coordinate (left, top, right, bottom) dalla bounding box
-                    left1, top1, right1, bottom1 = bbox.tolist()
-
-                    # Taglia l'immagine secondo la bounding box
-                    cropped_image1 = cropped_image.crop((left1, top1, right1, bottom1))
-                    
-                    # Calcola l'area del ritaglio corrente
-                    current_area = cropped_image1.size[0] * cropped_image1.size[1]
-                    
-                    if current_area > area:
-                        area = current_area
-                        tree = cropped_image1
-                        
-                        # Calcola la posizione della seconda bounding box nell'immagine originale
-                        absolute_left = left + left1
-                        absolute_top = top + top1
-                        absolute_right = left + right1
-                        absolute_bottom = img_height
-                        bboxp = (absolute_left, absolute_top, absolute_right, absolute_bottom)
-
-    tree_image=image.crop((absolute_left, absolute_top, absolute_right, absolute_bottom))
+    # migliore finora: (area, ordine del candidato) - a parità di area vince il primo rilevato, come prima
+    best = (0, -1)
+    bboxp = None
+    batch_size = max(1, int(batch_size))
+    while candidates:
+        candidates = [cand for cand in candidates
+                      if cand[1] > best[0] or (cand[1] == best[0] and best[1] >= 0 and cand[2] < best[1])]
+        batch, candidates = candidates[:batch_size], candidates[batch_size:]
+        if not batch:
+            break
+        crops = [crop_region(frame, cand[0]) for cand in batch]
+        valid = [k for k, crop in enumerate(crops) if min(image_size(crop)) > 0]
+        crop_side = max((max(image_size(crops[k])) for k in valid), default=0)
+        d = predict_tiles(model, [crops[k] for k in valid], batch_size=len(valid) or 1, conf=confidence,
+                          imgsz=stage_imgsz(imgsz, crop_side, min_object_px=min_object_px))
+        for k, result in zip(valid, d):
+            (left, top, right, bottom), _, order = batch[k]
+            for bbox in result.boxes.xyxy:
+                # Estrai le coordinate (left, top, right, bottom) dalla bounding box
+                left1, top1, right1, bottom1 = bbox.tolist()
+                l1, t1, r1, b1 = crop_box((left1, top1, right1, bottom1))
+                current_area = (r1 - l1) * (b1 - t1)
+                if current_area > best[0] or (current_area == best[0] and best[1] >= 0 and order < best[1]):
+                    best = (current_area, order)
+                    # Calcola la posizione della seconda bounding box nell'immagine originale
+                    absolute_left = left + left1
+                    absolute_top = top + top1
+                    absolute_right = left + right1
+                    absolute_bottom = img_height
+                    bboxp = (absolute_left, absolute_top, absolute_right, absolute_bottom)
+
+    if bboxp is None:
+        # nessun albero trovato nei ritagli: stesso ritaglio centrale del caso senza box
+        w, h = img_width, img_height
+        bboxp = (int(w * 0.25), int(h * 0.15), int(w * 0.75), int(h * 0.85))
+    box = crop_box(bboxp)
+    tree_image = crop_region(frame, box)
    
     print("... TREE DETECTION DONE")
-    return tree_image
+    return tree_image, box
 
 ####funzione che corregge la distorsione dell'immagine
 
+def to_frame(image):
+    """
+    Converte una volta sola un'immagine PIL RGB nel frame NumPy BGR contiguo che ultralytics
+    si aspetta; tile e ritagli del frame sono poi viste senza copia. Un ndarray passa invariato.
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    return np.ascontiguousarray(np.asarray(image.convert("RGB"))[:, :, ::-1])
+
+def image_size(image):
+    """(larghezza, altezza) di un'immagine PIL o di un frame NumPy."""
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    return image.size
+
+def crop_region(image, box, pad_value=0):
+    """
+    Ritaglio (left, top, right, bottom) con la stessa semantica di PIL Image.crop.
+    Su un frame NumPy restituisce una vista; solo se il riquadro esce dall'immagine crea
+    una copia, riempiendo la parte esterna con `pad_value` come fa PIL.
+    """
+    if not isinstance(image, np.ndarray):
+        return image.crop(box)
+    left, top, right, bottom = (int(round(v)) for v in box)
+    height, width = image.shape[:2]
+    if left >= 0 and top >= 0 and right <= width and bottom <= height:
+        return image[top:max(top, bottom), left:max(left, right)]
+    out = np.full((max(0, bottom - top), max(0, right - left)) + image.shape[2:], pad_value, dtype=image.dtype)
+    sx1, sy1 = max(left, 0), max(top, 0)
+    sx2, sy2 = min(right, width), min(bottom, height)
+    if sx2 > sx1 and sy2 > sy1:
+        out[sy1 - top:sy2 - top, sx1 - left:sx2 - left] = image[sy1:sy2, sx1:sx2]
+    return out
+
 def divide_image(image):
-    # Ottieni le dimensioni dell'immagine
-    width, height = image.size
+    # Ottieni le dimensioni dell'immagine (PIL o frame NumPy: in quel caso le tile sono viste)
+    width, height = image_size(image)
     
     # Calcola le dimensioni di ciascuna parte
     part_width = width // 15  # Dividi l'immagine in 5 parti orizzontali
@@ -148,68 +250,366 @@ def divide_image(image):
             lower = (i + 1) * part_height
             
             # Effettua il ritaglio dell'immagine
-            cropped_image = image.crop((left, upper, right, lower))
+            cropped_image = crop_region(image, (left, upper, right, lower))
             
             # Aggiungi l'immagine ritagliata e la posizione alla lista
             divided_images.append(cropped_image)
             positions.append((left, upper))
     
+    profiling.count("tiles", len(divided_images))
     return divided_images, positions
 
+def tile_offsets(length, tile_size, stride):
+    """Origini delle finestre lungo un asse: passo `stride`, l'ultima allineata al bordo."""
+    if length <= tile_size:
+        return [0]
+    offsets = list(range(0, length - tile_size + 1, stride))
+    if offsets[-1] != length - tile_size:
+        offsets.append(length - tile_size)
+    return offsets
+
+def sliding_tiles(image, tile_size=640, overlap=0.2, pad_value=114):
+    """
+    Divide l'immagine in finestre tile_size x tile_size sovrapposte di `overlap` (frazione del lato),
+    coprendo tutti i pixel fino ai bordi. Se l'immagine è più piccola della finestra su un asse,
+    la tile viene completata con `pad_value` (grigio come il letterbox di YOLO), così il modello
+    la riceve già alla sua dimensione nativa. Restituisce (tile, posizioni) come divide_image;
+    con un frame NumPy le tile interne sono viste, solo quelle di bordo da completare sono copie.
+    """
+    width, height = image_size(image)
+    stride = max(1, int(round(tile_size * (1 - overlap))))
+    tiles = []
+    positions = []
+    for top in tile_offsets(height, tile_size, stride):
+        for left in tile_offsets(width, tile_size, stride):
+            tile = crop_region(image, (left, top, min(left + tile_size, width), min(top + tile_size, height)))
+            if isinstance(tile, np.ndarray):
+                if tile.shape[:2] != (tile_size, tile_size):
+                    padded = np.full((tile_size, tile_size) + tile.shape[2:], pad_value, dtype=tile.dtype)
+                    padded[:tile.shape[0], :tile.shape[1]] = tile
+                    tile = padded
+            elif tile.size != (tile_size, tile_size):
+                padded = Image.new(tile.mode, (tile_size, tile_size), (pad_value,) * len(tile.getbands()))
+                padded.paste(tile, (0, 0))
+                tile = padded
+            tiles.append(tile)
+            positions.append((left, top))
+
+    profiling.count("tiles", len(tiles))
+    return tiles, positions
+
+def box_overlap(box, boxes, metric="iou"):
+    """
+    Sovrapposizione tra una box (4,) e le box (N, 4): "iou" (intersezione / unione) oppure
+    "ios" (intersezione / area della più piccola, utile per le arance tagliate sul bordo di una tile).
+    """
+    ix1 = np.maximum(box[0], boxes[:, 0])
+    iy1 = np.maximum(box[1], boxes[:, 1])
+    ix2 = np.minimum(box[2], boxes[:, 2])
+    iy2 = np.minimum(box[3], boxes[:, 3])
+    inter = np.clip(ix2 - ix1, 0, None) * np.clip(iy2 - iy1, 0, None)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    if metric == "iou":
+        denom = area + areas - inter
+    elif metric == "ios":
+        denom = np.minimum(area, areas)
+    else:
+        raise ValueError(f"Unknown overlap metric: {metric}")
+    return np.where(denom > 0, inter / np.maximum(denom, 1e-9), 0.0)
+
+def merge_boxes(boxes, scores, method="nms", iou_threshold=0.5, metric="iou"):
+    """
+    Unisce le box (N, 4) rilevate su tile sovrapposte.
+    "nms" tiene la box più confidente di ogni gruppo; "wbf" (weighted boxes fusion) la sostituisce
+    con la media delle box del gruppo pesata sulla confidenza. Restituisce (box, confidenze)
+    ordinate per confidenza decrescente.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    if method not in ("nms", "wbf"):
+        raise ValueError(f"Unknown merge method: {method}")
+    order = np.argsort(-scores, kind="stable")
+    boxes, scores = boxes[order], scores[order]
+    remaining = np.ones(len(boxes), dtype=bool)
+    merged_boxes, merged_scores = [], []
+    for k in range(len(boxes)):
+        if not remaining[k]:
+            continue
+        group = remaining & (box_overlap(boxes[k], boxes, metric) >= iou_threshold)
+        group[k] = True
+        remaining &= ~group
+        if method == "nms":
+            merged_boxes.append(boxes[k])
+        else:
+            weights = scores[group]
+            merged_boxes.append((boxes[group] * weights[:, None]).sum(axis=0) / weights.sum())
+        merged_scores.append(scores[k])
+    if not merged_boxes:
+        return np.zeros((0, 4)), np.zeros(0)
+    return np.array(merged_boxes), np.array(merged_scores)
+
+def detect_tiled(model, image, tile_size=None, overlap=0.2, merge="nms", iou_threshold=0.5,
+                 metric="iou", batch_size=16, imgsz=None, object_size=None, min_object_px=32, **kwargs):
+    """
+    Rileva gli oggetti su tutta l'immagine per tile e restituisce (box (N, 4), confidenze (N,))
+    nelle coordinate dell'immagine. Con `tile_size` None usa la griglia fissa di divide_image
+    (senza sovrapposizione né unione); altrimenti finestre sovrapposte di sliding_tiles alla
+    dimensione nativa del modello, con le box unite tra tile da merge_boxes.
+    `imgsz` è la dimensione di inferenza (intero, None o "auto", vedi stage_imgsz).
+    """
+    if tile_size is None:
+        tiles, positions = divide_image(image)
+        tile_side = max(max(image_size(tile)) for tile in tiles)
+        predictions = predict_tiles(model, tiles, batch_size=batch_size,
+                                    imgsz=stage_imgsz(imgsz, tile_side, object_size, min_object_px), **kwargs)
+        boxes, scores, _ = tile_boxes(predictions, positions)
+        return boxes, scores
+
+    tiles, positions = sliding_tiles(image, tile_size=tile_size, overlap=overlap)
+    imgsz = stage_imgsz(imgsz if imgsz is not None else tile_size, tile_size, object_size, min_object_px)
+    predictions = predict_tiles(model, tiles, batch_size=batch_size, imgsz=imgsz, **kwargs)
+    boxes, scores, _ = tile_boxes(predictions, positions)
+    # niente box nel padding oltre il bordo dell'immagine
+    width, height = image_size(image)
+    boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, width)
+    boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, height)
+    # le box tutte nel padding diventano degeneri dopo il clip: non sono arance
+    keep = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+    boxes, scores = boxes[keep], scores[keep]
+    return merge_boxes(boxes, scores, method=merge, iou_threshold=iou_threshold, metric=metric)
+
 def adjust_bbox_coordinates(bbox, position):
     x1, y1, x2, y2 = bbox
     x_offset, y_offset = position
     return (x1 + x_offset, y1 + y_offset, x2 + x_offset, y2 + y_offset)
 
-def correct_image(image, model_path, confidence=0.5):
-    print("IMAGE CORRECTION STARTING")
-    divided_images, positions = divide_image(image)
-    all_bboxes = []
-    model = YOLO(model_path)
-    if cuda.is_available():
-        print("...switching model to cuda")
-        model.to("cuda")
-
-    for i, img in enumerate(divided_images):
-        img_cv = np.array(img)
-        gray = cv2.cvtColor(img_cv, cv2.COLOR_RGB2GRAY)
-        prediction = model.predict(source=img, conf=confidence, save=False)
-        if prediction:
-            for bbox in prediction:
-                if len(bbox.boxes.xyxy) > 0:
-                    for j in range(len(bbox.boxes.xyxy)):
-                        x1, y1, x2, y2 = (bbox.boxes.xyxy)[j]
-                        adjusted_bbox = adjust_bbox_coordinates((x1.item(), y1.item(), x2.item(), y2.item()), positions[i])
-                        x1, y1, x2, y2 = map(int, adjusted_bbox)
-                        all_bboxes.append((x1, y1, x2, y2))
-
-    coeff=[]
-    if len(all_bboxes)==0:
-        ow, oh = image.size
-        coeff = 0.85                # coefficiente di fallback realistico
-        nw = (ow * coeff)
-        corrected_image = image.resize((round(nw), oh), Image.Resampling.LANCZOS)
+def auto_imgsz(source_size, object_size=None, min_object_px=32, stride=32, max_size=640):
+    """
+    Dimensione di inferenza più piccola (multiplo di `stride`, al massimo `max_size`) per cui oggetti
+    di `object_size` pixel, in un'immagine di lato massimo `source_size`, restano di almeno
+    `min_object_px` pixel. Senza `object_size` usa la risoluzione nativa, senza ingrandire.
+    """
+    if object_size is None or object_size <= 0:
+        target = source_size
     else:
-    # Mostra ogni arancia ritagliata una per volta
-        for idx, bbox in enumerate(all_bboxes):
-            x1, y1, x2, y2 = bbox
-            cropped_img = image.crop((x1, y1, x2, y2))
-            original_width, original_height = cropped_img.size
-            if original_width < original_height:
-                new_size = (original_width, original_width)  # Usa la larghezza come nuova dimensione per entrambe
-                c= original_width/original_height
-                coeff.append(c)
-            else:
-                new_size = (original_height, original_height)  # Usa l'altezza come nuova dimensione per entrambe
-                c= original_height/original_width
-                coeff.append(c)
-        
-            ow,oh=image.size
-            nw=ow*np.mean(coeff)
-            corrected_image = image.resize((round(nw), oh), Image.Resampling.LANCZOS)
-            
-            print("... IMAGE CORRECTION DONE")
-        return corrected_image
+        target = source_size * min_object_px / object_size
+    target = min(target, max_size)
+    return int(max(stride, math.ceil(target / stride) * stride))
+
+# dimensione di inferenza di default di ultralytics, usata dove serve un valore concreto per imgsz=None
+DEFAULT_IMGSZ = 640
+
+def stage_imgsz(setting, source_size, object_size=None, min_object_px=32, stride=32, max_size=640):
+    """imgsz di una fase: un intero fisso, None (default di ultralytics) oppure "auto" (auto_imgsz)."""
+    if setting == "auto":
+        return auto_imgsz(source_size, object_size, min_object_px=min_object_px, stride=stride, max_size=max_size)
+    return setting
+
+def typical_object_size(boxes):
+    """Lato corto mediano delle box (N, 4), None se non ce ne sono: la scala degli oggetti per "auto"."""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    if len(boxes) == 0:
+        return None
+    return float(np.median(np.minimum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1])))
+
+def predict_tiles(model, tiles, batch_size=16, **kwargs):
+    """
+    Esegue il modello sulle tile a mini-batch invece che una alla volta.
+    Restituisce un risultato per ogni tile, nello stesso ordine di `tiles`,
+    così che l'indice resti allineato con `positions` di divide_image.
+    Con imgsz=None si usa la dimensione di default di ultralytics. Ogni chiamata tiene il lock
+    del modello, così più sessioni possono usare lo stesso modello da thread diversi.
+    """
+    if kwargs.get("imgsz", 0) is None:
+        del kwargs["imgsz"]
+    results = []
+    batch_size = max(1, int(batch_size))
+    lock = model_lock(model)
+    for start in range(0, len(tiles), batch_size):
+        batch = tiles[start:start + batch_size]
+        with lock:
+            results.extend(model.predict(source=batch, save=False, verbose=False, **kwargs))
+        profiling.count("model_calls")
+    return results
+
+def classify_crops(model, crops, imgsz=640, batch_size=32, min_object_px=64, **kwargs):
+    """
+    Classifica la maturazione di tutti i ritagli con poche chiamate a batch.
+    I ritagli (PIL o viste NumPy BGR) vengono ridimensionati a una dimensione comune (imgsz x imgsz) e
+    per ognuno viene restituita la classe della prima box trovata, oppure None
+    se il modello non trova nulla. L'ordine è quello di `crops`.
+    Con imgsz "auto" la dimensione è la più piccola che tiene il frutto mediano ad almeno
+    `min_object_px` pixel, invece di ingrandire ogni ritaglio a 640; None vale DEFAULT_IMGSZ.
+    """
+    classes = [None] * len(crops)
+    # i ritagli vuoti (box degeneri) non possono essere classificati
+    valid = [k for k, crop in enumerate(crops) if min(image_size(crop)) > 0]
+    if not valid:
+        return classes
+    if imgsz == "auto":
+        sizes = np.array([image_size(crops[k]) for k in valid])
+        imgsz = auto_imgsz(float(np.median(sizes.max(axis=1))), float(np.median(sizes.min(axis=1))),
+                           min_object_px=min_object_px)
+    elif imgsz is None:
+        imgsz = DEFAULT_IMGSZ
+    resized = [cv2.resize(crops[k], (imgsz, imgsz), interpolation=cv2.INTER_LINEAR)
+               if isinstance(crops[k], np.ndarray)
+               else crops[k].resize((imgsz, imgsz), Image.Resampling.BILINEAR) for k in valid]
+    profiling.count("crops", len(resized))
+    results = predict_tiles(model, resized, batch_size=batch_size, imgsz=imgsz, **kwargs)
+    for k, result in zip(valid, results):
+        if len(result.boxes) > 0:
+            cls = int(result.boxes.cls.cpu().numpy()[0])
+            classes[k] = int(result.names[cls])
+    return classes
+
+def tile_boxes(predictions, positions):
+    """
+    Raccoglie le box di tutte le tile in un unico array (N, 4) xyxy nelle coordinate
+    dell'immagine intera, con le confidenze (N,) e l'indice della tile di provenienza (N,).
+    """
+    boxes, scores, tiles = [], [], []
+    for i, (result, position) in enumerate(zip(predictions, positions)):
+        if len(result.boxes) == 0:
+            continue
+        xyxy = result.boxes.xyxy.cpu().numpy().astype(np.float64)
+        xyxy[:, [0, 2]] += position[0]
+        xyxy[:, [1, 3]] += position[1]
+        boxes.append(xyxy)
+        scores.append(result.boxes.conf.cpu().numpy())
+        tiles.append(np.full(len(xyxy), i))
+    if not boxes:
+        return np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype=int)
+    return np.concatenate(boxes), np.concatenate(scores), np.concatenate(tiles)
+
+def squash_coefficient(boxes, fallback=0.85):
+    """
+    Rapporto medio lato corto / lato lungo delle box (N, 4): le arance sono tonde, quindi
+    misura quanto il mosaico è stirato in orizzontale. Senza box valide usa `fallback`.
+    """
+    # come nel ritaglio PIL le coordinate vengono troncate a intero
+    boxes = np.trunc(np.asarray(boxes, dtype=np.float64).reshape(-1, 4))
+    widths = boxes[:, 2] - boxes[:, 0]
+    heights = boxes[:, 3] - boxes[:, 1]
+    longest = np.maximum(widths, heights)
+    valid = longest > 0
+    if not valid.any():
+        return fallback
+    return float(np.mean(np.minimum(widths, heights)[valid] / longest[valid]))
+
+def correct_image(image, model_path, confidence=0.5, batch_size=16, **tiling):
+    """
+    Corregge la distorsione orizzontale del mosaico: rileva le arance su tutte le tile a batch,
+    stima in un colpo solo il rapporto d'aspetto medio delle box e ridimensiona l'immagine una volta.
+    `tiling` (tile_size, overlap, merge, iou_threshold, metric) viene passato a detect_tiled.
+    """
+    corrected_image, _, _ = correct_image_with_detections(image, model_path, confidence=confidence,
+                                                          detection_confidence=confidence,
+                                                          batch_size=batch_size, **tiling)
+    return corrected_image
+
+def correct_image_with_detections(image, model_path, confidence=0.5, detection_confidence=0.1, batch_size=16,
+                                  **tiling):
+    """
+    Come correct_image, ma restituisce anche le arance rilevate per poterle riusare nel conteggio:
+    la rilevazione gira alla confidenza più bassa tra le due, la correzione usa solo le box con
+    confidenza >= `confidence`. Restituisce (frame BGR corretto, box (N, 4) nelle coordinate
+    dell'immagine corretta con confidenza >= `detection_confidence`, confidenze (N,)).
+    `model_path` può essere anche un modello già caricato; `image` è il frame BGR del mosaico
+    (un'immagine PIL viene convertita una volta sola).
+    """
+    print("IMAGE CORRECTION STARTING")
+    model = resolve_model(model_path)
+
+    # le tile sono viste del frame BGR
+    frame = to_frame(image)
+    all_bboxes, scores = detect_tiled(model, frame, batch_size=batch_size,
+                                      conf=min(confidence, detection_confidence), **tiling)
+
+    # coefficiente di fallback realistico se non ci sono arance
+    coeff = squash_coefficient(all_bboxes[scores >= confidence], fallback=0.85)
+    ow, oh = image_size(frame)
+    nw = round(ow * coeff)
+    corrected_image = cv2.resize(frame, (nw, oh), interpolation=cv2.INTER_LANCZOS4)
+
+    # le box seguono lo stesso ridimensionamento orizzontale dell'immagine
+    keep = scores >= detection_confidence
+    boxes = all_bboxes[keep].copy()
+    boxes[:, [0, 2]] *= nw / ow
+
+    print("... IMAGE CORRECTION DONE")
+    return corrected_image, boxes, scores[keep]
+
+def contained_mask(boxes):
+    """
+    Per ogni box (N, 4) xyxy dice se è contenuta (bordi compresi) in un'altra box dell'elenco;
+    due box identiche si contengono a vicenda e risultano entrambe contenute.
+    Sort-and-sweep su x1: ogni box viene confrontata solo con le box "attive", cioè già iniziate
+    (x1 <= x1 corrente) e non ancora finite (x2 >= x1 corrente), quasi lineare per box distribuite
+    lungo l'immagine come i pali.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    n = len(boxes)
+    contained = np.zeros(n, dtype=bool)
+    order = np.lexsort((-boxes[:, 2], boxes[:, 0]))
+    active = np.zeros(0, dtype=int)
+    start = 0
+    while start < n:
+        # le box con lo stesso x1 possono contenersi a vicenda: entrano insieme tra le attive
+        x1 = boxes[order[start], 0]
+        end = start
+        while end < n and boxes[order[end], 0] == x1:
+            end += 1
+        group = order[start:end]
+        active = active[boxes[active, 2] >= x1]
+        active = np.concatenate([active, group])
+        candidates = boxes[active]
+        for i in group:
+            box = boxes[i]
+            hit = ((candidates[:, 1] <= box[1]) & (candidates[:, 2] >= box[2])
+                   & (candidates[:, 3] >= box[3]) & (active != i))
+            contained[i] = hit.any()
+        start = end
+    return contained
+
+def filter_contained_boxes(boxes):
+    """Elimina le box contenute in un'altra box dell'elenco (vedi contained_mask), mantenendo l'ordine."""
+    contained = contained_mask(boxes)
+    return [box for box, inside in zip(boxes, contained) if not inside]
+
+def boxes_in_crop(boxes, box):
+    """
+    Porta le box (N, 4) nelle coordinate del ritaglio `box` (left, top, right, bottom):
+    tiene quelle con il centro dentro il ritaglio e le limita ai suoi bordi.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    left, top, right, bottom = box
+    shifted = boxes - np.array([left, top, left, top], dtype=np.float64)
+    width, height = right - left, bottom - top
+    cx = (shifted[:, 0] + shifted[:, 2]) / 2
+    cy = (shifted[:, 1] + shifted[:, 3]) / 2
+    inside = (cx >= 0) & (cx < width) & (cy >= 0) & (cy < height)
+    shifted = shifted[inside]
+    shifted[:, [0, 2]] = np.clip(shifted[:, [0, 2]], 0, width)
+    shifted[:, [1, 3]] = np.clip(shifted[:, [1, 3]], 0, height)
+    return shifted, inside
+
+def assign_boxes_to_tiles(boxes, positions, sizes):
+    """
+    Indice della tile (posizione + dimensione) che contiene il centro di ciascuna box (N, 4);
+    i centri fuori da ogni tile (resto della divisione intera) vanno alla tile più vicina.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=int)
+    centers = np.stack([(boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2], axis=1)
+    origins = np.asarray(positions, dtype=np.float64)
+    ends = origins + np.asarray(sizes, dtype=np.float64)
+    # distanza del centro da ogni rettangolo (0 se contenuto)
+    dx = np.maximum(np.maximum(origins[None, :, 0] - centers[:, None, 0], centers[:, None, 0] - (ends[None, :, 0] - 1)), 0)
+    dy = np.maximum(np.maximum(origins[None, :, 1] - centers[:, None, 1], centers[:, None, 1] - (ends[None, :, 1] - 1)), 0)
+    return np.argmin(dx * dx + dy * dy, axis=1)
 
 #immagine_corretta=detect_and_plot_arances(img_pil)
 #immagine_corretta.save("immagine con distorsione corretta.jpeg")
@@ -279,6 +679,134 @@ def interpolate_coefficient(p, centroids, coeff):
 
     return np.dot(bary_coords, tri_coeffs)
 
+def interpolate_coefficients(points, centroids, coeff):
+    """
+    Versione vettoriale di interpolate_coefficient per M punti (M, 2) in un colpo solo:
+    i 3 centroidi più vicini di ogni punto con argpartition e tutte le coordinate
+    baricentriche con un'unica np.linalg.solve a batch. Restituisce un array (M,).
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    centroids = np.asarray(centroids, dtype=np.float64).reshape(-1, 2)
+    coeff = np.asarray(coeff, dtype=np.float64).reshape(-1)
+
+    if len(centroids) == 0:
+        return np.zeros(len(points))
+    if len(centroids) == 1:
+        return np.full(len(points), coeff[0])
+    if len(centroids) == 2:
+        d1 = np.linalg.norm(points - centroids[0], axis=1)
+        d2 = np.linalg.norm(points - centroids[1], axis=1)
+        total = d1 + d2
+        safe = np.where(total == 0, 1, total)
+        values = (1 - d1 / safe) * coeff[0] + (1 - d2 / safe) * coeff[1]
+        return np.where(total == 0, coeff[0], values)
+    if len(points) == 0:
+        return np.zeros(0)
+
+    # 3 centroidi più vicini per ogni punto (l'ordine non conta per le baricentriche)
+    distances = np.linalg.norm(points[:, None, :] - centroids[None, :, :], axis=2)
+    if len(centroids) > 3:
+        idx = np.argpartition(distances, 2, axis=1)[:, :3]
+    else:
+        idx = np.broadcast_to(np.arange(3), (len(points), 3))
+    return barycentric_interpolate(points, centroids[idx], coeff[idx])
+
+def barycentric_interpolate(points, triangles, values):
+    """
+    Interpolazione baricentrica a batch: `points` (M, 2), `triangles` (M, 3, 2) con i vertici
+    e `values` (M, 3) i valori nei vertici. Triangoli degeneri → media dei tre valori.
+    """
+    tri = triangles
+    A = np.ones((len(points), 3, 3))
+    A[:, 0, :] = tri[:, :, 0]
+    A[:, 1, :] = tri[:, :, 1]
+    b = np.stack([points[:, 0], points[:, 1], np.ones(len(points))], axis=1)
+
+    # triangoli degeneri → pesi uniformi, come calculate_barycentric_coordinates
+    degenerate = np.abs(np.linalg.det(A)) < 1e-8
+    A[degenerate] = np.eye(3)
+    bary = np.linalg.solve(A, b[:, :, None])[:, :, 0]
+    bary[degenerate] = 1 / 3
+    return np.einsum("ij,ij->i", bary, values)
+
+class CoefficientInterpolator:
+    """
+    Superficie del coefficiente mm/pixel costruita una volta per immagine dai pali
+    (centroidi e coefficienti di calculate_coefficient).
+    Dentro l'inviluppo convesso dei pali interpola nel triangolo di Delaunay che contiene il punto;
+    fuori usa i 3 pali più vicini trovati con un KD-tree (come interpolate_coefficient).
+    Con rasterize() le interrogazioni successive leggono una mappa densa precalcolata.
+    """
+
+    def __init__(self, centroids, coeff):
+        self.centroids = np.asarray(centroids, dtype=np.float64).reshape(-1, 2)
+        self.coeff = np.asarray(coeff, dtype=np.float64).reshape(-1)
+        self.delaunay = None
+        self.kdtree = None
+        self.scale_map = None
+        self.step = None
+        if Delaunay is not None and len(self.centroids) >= 3:
+            self.kdtree = cKDTree(self.centroids)
+            try:
+                self.delaunay = Delaunay(self.centroids)
+            except RuntimeError:  # QhullError: pali tutti allineati, niente triangolazione
+                self.delaunay = None
+
+    def query(self, points):
+        """Coefficienti esatti (M,) nei punti (M, 2)."""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if self.kdtree is None or len(points) == 0:
+            return interpolate_coefficients(points, self.centroids, self.coeff)
+
+        values = np.empty(len(points))
+        simplex = np.full(len(points), -1)
+        if self.delaunay is not None:
+            simplex = self.delaunay.find_simplex(points)
+        inside = simplex >= 0
+        if inside.any():
+            transform = self.delaunay.transform[simplex[inside]]
+            b = np.einsum("ijk,ik->ij", transform[:, :2], points[inside] - transform[:, 2])
+            bary = np.column_stack([b, 1 - b.sum(axis=1)])
+            values[inside] = np.einsum("ij,ij->i", bary, self.coeff[self.delaunay.simplices[simplex[inside]]])
+        outside = ~inside
+        if outside.any():
+            _, idx = self.kdtree.query(points[outside], k=3)
+            values[outside] = barycentric_interpolate(points[outside], self.centroids[idx], self.coeff[idx])
+        return values
+
+    def rasterize(self, width, height, step=8):
+        """Precalcola la mappa dei coefficienti su una griglia di `step` pixel che copre width x height."""
+        step = max(1, int(step))
+        xs = np.arange(0, width, step) + step / 2
+        ys = np.arange(0, height, step) + step / 2
+        gx, gy = np.meshgrid(xs, ys)
+        grid = np.column_stack([gx.ravel(), gy.ravel()])
+        self.scale_map = self.query(grid).reshape(len(ys), len(xs))
+        self.step = step
+        return self.scale_map
+
+    def __call__(self, points):
+        """Coefficienti (M,) nei punti (M, 2): dalla mappa se rasterizzata, altrimenti esatti."""
+        if self.scale_map is None:
+            return self.query(points)
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        rows, cols = self.scale_map.shape
+        ix = np.clip((points[:, 0] // self.step).astype(int), 0, cols - 1)
+        iy = np.clip((points[:, 1] // self.step).astype(int), 0, rows - 1)
+        return self.scale_map[iy, ix]
+
+def estimate_diameters(boxes, interpolator):
+    """
+    Diametri (mm, arrotondati) di tutte le arance (N, 4) xyxy in un solo passaggio vettoriale:
+    altezza della box per il coefficiente dei pali (CoefficientInterpolator) nel suo centro.
+    Restituisce (diametri (N,), centri (N, 2)).
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    centers = np.stack([(boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2], axis=1)
+    heights = np.abs(boxes[:, 3] - boxes[:, 1])
+    values = interpolator(centers)
+    return np.round(heights * np.abs(values)), centers
+
 def adjust_bbox_coordinates(bbox, position):
     x1, y1, x2, y2 = bbox
     x_offset, y_offset = position
@@ -286,30 +814,50 @@ def adjust_bbox_coordinates(bbox, position):
 
 
 
-def fruit_weight_by_diameter(diameter):
-    # Dictionary mapping diameter ranges to average fruit weight in grams
-    diameter_to_weight = {
-        (100, float('inf')): 420,
-        (87, 100): 360,
-        (81, 96): 300,
-        (77, 84): 280,
-        (73, 84): 250,
-        (70, 80): 220,
-        (67, 76): 190,
-        (64, 73): 160,
-        (62, 70): 150,
-        (60, 68): 130,
-        (56, 63): 120,
-        (53, 60): 110,
-        (0,60):100
-    }
-
-    # Determine the weight based on the diameter
-    for range, weight in diameter_to_weight.items():
-        if range[0] <= diameter <= range[1]:
-            return weight
-
-    return "Weight not found for the given diameter."
+DEFAULT_WEIGHT_CALIBRATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "calibration",
+                                          "orange_default.json")
+
+class WeightTable:
+    """
+    Tabella di calibrazione diametro (mm) -> peso medio (g) di una varietà.
+    `breakpoints` ordinati: il diametro d ha il peso della classe i con
+    breakpoints[i] <= d < breakpoints[i+1] (l'ultima classe è aperta verso l'alto,
+    i diametri sotto il primo breakpoint prendono la prima classe).
+    """
+
+    def __init__(self, breakpoints, weights, variety=None):
+        self.breakpoints = np.asarray(breakpoints, dtype=np.float64)
+        self.weights = np.asarray(weights)
+        self.variety = variety
+        if self.breakpoints.ndim != 1 or len(self.breakpoints) != len(self.weights) or len(self.weights) == 0:
+            raise ValueError("Weight calibration needs one weight per breakpoint")
+        if np.any(np.diff(self.breakpoints) <= 0):
+            raise ValueError("Weight calibration breakpoints must be strictly increasing")
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as fp:
+            data = json.load(fp)
+        return cls(data["breakpoints_mm"], data["weights_g"], variety=data.get("variety"))
+
+    def __call__(self, diameters):
+        """Pesi (g) per un array di diametri (mm), in una sola ricerca vettoriale."""
+        idx = np.searchsorted(self.breakpoints, np.asarray(diameters, dtype=np.float64), side="right") - 1
+        return self.weights[np.clip(idx, 0, len(self.weights) - 1)]
+
+_weight_tables = {}
+
+def load_weight_table(path=DEFAULT_WEIGHT_CALIBRATION):
+    """Restituisce la tabella di calibrazione del file `path`, letta una volta per processo."""
+    key = os.path.abspath(path)
+    table = _weight_tables.get(key)
+    if table is None:
+        table = _weight_tables[key] = WeightTable.from_file(key)
+    return table
+
+def fruit_weight_by_diameter(diameter, calibration=DEFAULT_WEIGHT_CALIBRATION):
+    # peso medio in grammi dalla tabella di calibrazione della varietà
+    return int(load_weight_table(calibration)([diameter])[0])
 
 
 
@@ -0,0 +1,174 @@
+"""
+Rielaborazione in blocco di molte cartelle di sessione (ad esempio una stagione di acquisizioni
+dopo un aggiornamento dei modelli).
+
+Le sessioni (percorsi o glob) vengono distribuite su un pool di processi; ogni processo limita i
+thread di torch, carica i modelli una volta sola e analizza una sessione alla volta. Ogni risultato
+(globalResults più il campo "session") viene aggiunto appena pronto a un file JSONL, che fa anche
+da stato di avanzamento: rilanciando lo stesso comando le sessioni già completate vengono saltate.
+Con --parquet alla fine il JSONL viene convertito anche in Parquet (richiede pandas e pyarrow).
+
+Esempi:
+    python batch_runner.py "dataset/*" --workers 2 --torch-threads 2 --output runs/season.jsonl
+    python batch_runner.py /data/2024/*/ --output runs/2024.jsonl --parquet runs/2024.parquet
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+
+# configurazione del processo worker, impostata da _init_worker
+_worker_config = None
+
+
+def expand_sessions(patterns):
+    """Cartelle di sessione (ordinate, senza duplicati) da percorsi e glob."""
+    sessions = []
+    for pattern in patterns:
+        matches = glob.glob(pattern) or [pattern]
+        sessions.extend(os.path.abspath(path) for path in matches if os.path.isdir(path))
+    return sorted(set(sessions))
+
+
+def completed_sessions(output):
+    """Sessioni già presenti nel JSONL senza errori (quelle fallite vengono ritentate)."""
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # riga troncata da un'interruzione
+            if "error" not in record and "session" in record:
+                done.add(record["session"])
+    return done
+
+
+def _init_worker(config, torch_threads):
+    """Inizializzatore dei processi: limita i thread di torch e carica i modelli."""
+    global _worker_config
+    import torch
+    from pipeline import load_pipeline_models
+    if torch_threads:
+        torch.set_num_threads(torch_threads)
+    _worker_config = config
+    load_pipeline_models(config)
+
+
+def _analyze(folder_path):
+    from pipeline import analyze_session
+    try:
+        results = analyze_session(folder_path, _worker_config)
+    except Exception as e:
+        traceback.print_exc()
+        results = {"error": repr(e)}
+    return {"session": folder_path, **results}
+
+
+def append_record(output, record):
+    """Aggiunge una riga al JSONL e la scrive subito su disco."""
+    with open(output, "a") as fp:
+        fp.write(json.dumps(record) + "\n")
+        fp.flush()
+        os.fsync(fp.fileno())
+
+
+def write_parquet(output, parquet_path):
+    """Converte il JSONL dei risultati in Parquet (pandas viene importato solo qui)."""
+    try:
+        import pandas as pd
+    except ImportError:
+        raise SystemExit("--parquet requires pandas (and pyarrow or fastparquet)")
+    records = []
+    with open(output) as fp:
+        for line in fp:
+            if line.strip():
+                records.append(json.loads(line))
+    os.makedirs(os.path.dirname(os.path.abspath(parquet_path)), exist_ok=True)
+    try:
+        pd.DataFrame.from_records(records).to_parquet(parquet_path, index=False)
+    except ImportError:
+        raise SystemExit("--parquet requires pandas (and pyarrow or fastparquet)")
+    print("parquet written to", parquet_path)
+
+
+def run_batch(sessions, output, config=None, workers=1, torch_threads=None, resume=True):
+    """Analizza le sessioni non ancora completate e aggiunge i risultati a `output`; restituisce il riepilogo."""
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    done = completed_sessions(output) if resume else set()
+    pending = [folder_path for folder_path in sessions if folder_path not in done]
+    print("sessions:", len(sessions), "already done:", len(sessions) - len(pending), "to process:", len(pending))
+    if not pending:
+        return {"processed": 0, "errors": 0, "skipped": len(sessions)}
+
+    workers = max(1, min(workers, len(pending)))
+    if torch_threads is None:
+        torch_threads = max(1, (os.cpu_count() or 1) // workers)
+
+    start = time.perf_counter()
+    errors = 0
+    # spawn: ogni worker parte pulito, senza ereditare i thread di torch/OpenCV del processo padre
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(config, torch_threads)) as pool:
+        futures = {pool.submit(_analyze, folder_path): folder_path for folder_path in pending}
+        for k, future in enumerate(as_completed(futures), start=1):
+            try:
+                record = future.result()
+            except Exception as e:  # il processo worker è morto
+                record = {"session": futures[future], "error": repr(e)}
+            if "error" in record:
+                errors += 1
+            append_record(output, record)
+            print(f"[{k}/{len(pending)}]", record["session"], "ERROR" if "error" in record else "ok")
+
+    elapsed = time.perf_counter() - start
+    return {"processed": len(pending), "errors": errors, "skipped": len(sessions) - len(pending),
+            "seconds": round(elapsed, 3)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Clever batch runner for session folders")
+    parser.add_argument("sessions", nargs="*", default=[os.path.join("dataset", "*")],
+                        help="cartelle di sessione o glob (default: dataset/*)")
+    parser.add_argument("--output", default=os.path.join("runs", "batch_results.jsonl"),
+                        help="JSONL in cui aggiungere i risultati (anche stato di avanzamento)")
+    parser.add_argument("--parquet", help="converte anche i risultati in questo file Parquet alla fine")
+    parser.add_argument("--workers", type=int, default=1, help="processi in parallelo")
+    parser.add_argument("--torch-threads", type=int,
+                        help="thread di torch per processo (default: CPU disponibili / workers)")
+    parser.add_argument("--config", help="file JSON che sovrascrive la configurazione della pipeline")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="rianalizza anche le sessioni già presenti nell'output")
+    args = parser.parse_args(argv)
+
+    config = None
+    if args.config:
+        with open(args.config) as fp:
+            config = json.load(fp)
+    # valida la configurazione prima di avviare i processi
+    from pipeline import load_config
+    load_config(config)
+
+    sessions = expand_sessions(args.sessions)
+    summary = run_batch(sessions, args.output, config, workers=args.workers,
+                        torch_threads=args.torch_threads, resume=not args.no_resume)
+    print("batch done:", summary)
+    if args.parquet:
+        write_parquet(args.output, args.parquet)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Benchmark della pipeline sulle sessioni di esempio in dataset/.
+
+Per ogni sessione esegue la pipeline completa (anche più volte con --repeat) e, grazie ai tempi
+per fase raccolti da profiling, riporta per ogni fase e per l'intera pipeline: tempo, immagini/s,
+picco di RSS durante la fase (solo Linux) e numero di chiamate ai modelli. Il risultato è un JSON
+confrontabile con una baseline precedente (--compare), per vedere subito le regressioni.
+
+Esempi:
+    python benchmark.py --output benchmarks/baseline.json
+    python benchmark.py --sessions dataset/0304 dataset/1205 --repeat 3 --compare benchmarks/baseline.json
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+from pipeline import BASE_PATH, analyze_session, load_config, load_pipeline_models
+import profiling
+
+
+DEFAULT_SESSIONS = sorted(glob.glob(os.path.join(BASE_PATH, "dataset", "*")))
+
+
+def benchmark_session(folder_path, config, repeat=1):
+    """Esegue `repeat` volte la pipeline sulla sessione e restituisce le mediane per fase."""
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = analyze_session(folder_path, config)
+        runs.append((time.perf_counter() - start, results))
+
+    images = runs[0][1]["sourceImages"]
+    wall = statistics.median(wall for wall, _ in runs)
+    stage_names = list(runs[0][1]["profiling"]["stageTimings"])
+    stages = {}
+    for name in stage_names:
+        seconds = statistics.median(r["profiling"]["stageTimings"].get(name, 0.0) for _, r in runs)
+        profile = runs[-1][1]["profiling"]
+        stages[name] = {
+            "seconds": round(seconds, 4),
+            "imagesPerSecond": round(images / seconds, 3) if seconds > 0 else None,
+            "peakRssMb": profile["peakRssMb"].get(name),
+            "modelCalls": profile["counters"].get(name, {}).get("model_calls", 0),
+        }
+    last = runs[-1][1]
+    # picco della sessione: il massimo dei picchi per fase (None dove non si possono misurare)
+    stage_peaks = last["profiling"]["peakRssMb"].values()
+    return {
+        "sourceImages": images,
+        "wallTime": round(wall, 4),
+        "imagesPerSecond": round(images / wall, 3) if wall > 0 else None,
+        "peakRssMb": max(stage_peaks) if stage_peaks else None,
+        "modelCalls": last["profiling"]["totals"].get("model_calls", 0),
+        "oranges": last["oranges"],
+        "stages": stages,
+    }
+
+
+def summarize(sessions):
+    """Somma dei tempi e delle chiamate per fase su tutte le sessioni."""
+    summary = {"wallTime": 0.0, "sourceImages": 0, "stages": {}}
+    for result in sessions.values():
+        summary["wallTime"] += result["wallTime"]
+        summary["sourceImages"] += result["sourceImages"]
+        for name, stage in result["stages"].items():
+            total = summary["stages"].setdefault(name, {"seconds": 0.0, "modelCalls": 0})
+            total["seconds"] = round(total["seconds"] + stage["seconds"], 4)
+            total["modelCalls"] += stage["modelCalls"]
+    summary["wallTime"] = round(summary["wallTime"], 4)
+    if summary["wallTime"] > 0:
+        summary["imagesPerSecond"] = round(summary["sourceImages"] / summary["wallTime"], 3)
+    return summary
+
+
+def compare(current, baseline, threshold, min_seconds=0.05):
+    """
+    Stampa il confronto fase per fase e restituisce le fasi in regressione: rapporto oltre
+    `threshold` e almeno `min_seconds` in più (le fasi brevissime sono solo rumore).
+    """
+    regressions = []
+    print()
+    print(f"{'stage':<28}{'baseline s':>12}{'current s':>12}{'ratio':>8}")
+    rows = [("TOTAL", baseline["summary"]["wallTime"], current["summary"]["wallTime"])]
+    for name, stage in current["summary"]["stages"].items():
+        old = baseline["summary"]["stages"].get(name)
+        if old is not None:
+            rows.append((name, old["seconds"], stage["seconds"]))
+    for name, old, new in rows:
+        ratio = new / old if old > 0 else float("inf")
+        flag = ""
+        if ratio > threshold and new - old > min_seconds:
+            flag = "  <-- REGRESSION"
+            regressions.append(name)
+        print(f"{name:<28}{old:>12.3f}{new:>12.3f}{ratio:>8.2f}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Clever pipeline benchmark")
+    parser.add_argument("--sessions", nargs="*", default=DEFAULT_SESSIONS,
+                        help="cartelle di sessione (default: tutte quelle in dataset/)")
+    parser.add_argument("--repeat", type=int, default=1, help="ripetizioni per sessione (si usa la mediana)")
+    parser.add_argument("--config", help="file JSON che sovrascrive la configurazione della pipeline")
+    parser.add_argument("--output", default=os.path.join("benchmarks", "latest.json"),
+                        help="file JSON in cui scrivere i risultati")
+    parser.add_argument("--compare", help="baseline JSON da confrontare con questa esecuzione")
+    parser.add_argument("--threshold", type=float, default=1.10,
+                        help="rapporto tempo attuale/baseline oltre il quale una fase è una regressione")
+    parser.add_argument("--min-seconds", type=float, default=0.05,
+                        help="aumento minimo in secondi per segnalare una regressione")
+    args = parser.parse_args(argv)
+
+    config = {}
+    if args.config:
+        with open(args.config) as fp:
+            config = json.load(fp)
+    # i tempi del benchmark non devono finire nel log di produzione
+    config.setdefault("timing_log", None)
+
+    start = time.perf_counter()
+    load_pipeline_models(config)
+    model_load_time = time.perf_counter() - start
+
+    sessions = {}
+    for folder_path in args.sessions:
+        name = os.path.basename(os.path.normpath(folder_path))
+        print("BENCHMARK SESSION", name)
+        sessions[name] = benchmark_session(folder_path, config, repeat=args.repeat)
+
+    report = {
+        "date": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "host": {"platform": platform.platform(), "machine": platform.machine(),
+                 "python": platform.python_version(), "cpus": os.cpu_count()},
+        "config": load_config(config),
+        "repeat": args.repeat,
+        "modelLoadTime": round(model_load_time, 4),
+        # picco dell'intero processo (caricamento dei modelli e tutte le sessioni)
+        "processPeakRssMb": round(profiling.peak_rss_mb() or 0.0, 1),
+        "sessions": sessions,
+        "summary": summarize(sessions),
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as fp:
+        json.dump(report, fp, indent=2)
+    print("benchmark written to", args.output)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        if compare(report, baseline, args.threshold, args.min_seconds):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Esecuzione a fasi sovrapposte di più sessioni.
+
+Le fasi di pipeline.SESSION_STAGES girano ognuna sui propri thread, collegate da code limitate:
+mentre la sessione N è nella rilevazione delle arance, la N+1 può essere già nello stitching
+(OpenCV) e la N+2 in decodifica. Con un arretrato di sessioni il throughput tende a quello della
+fase più lenta invece che alla somma di tutte le fasi. Le predizioni sullo stesso modello sono
+serializzate dal lock per modello del registro (vedi Auxiliary.predict_tiles).
+"""
+import queue
+import threading
+import time
+import traceback
+
+import profiling
+from pipeline import SESSION_STAGES, load_config, new_session, session_results, finish_session
+
+
+# segnale di fine lavoro per i thread di una fase
+_DONE = object()
+
+
+class StagedExecutor:
+    """
+    Esegue la pipeline su più sessioni con un pool di thread per ogni fase.
+    `workers` ({fase: thread}) e `queue_size` (sessioni in attesa tra due fasi) sovrascrivono
+    "stage_workers" e "stage_queue_size" della configurazione.
+    """
+
+    def __init__(self, config=None, workers=None, queue_size=None):
+        self.config = load_config(config)
+        if self.config["profiler"] is not None:
+            # cProfile e il profiler di torch registrano un solo thread: usare analyze_session
+            raise ValueError("The staged executor does not support profiler traces")
+        requested = dict(self.config["stage_workers"] or {})
+        requested.update(workers or {})
+        names = [name for name, _ in SESSION_STAGES]
+        unknown = set(requested) - set(names)
+        if unknown:
+            raise ValueError(f"Unknown pipeline stages: {sorted(unknown)}")
+        self.workers = {name: max(1, int(requested.get(name, 1))) for name in names}
+        self.queue_size = max(1, int(queue_size or self.config["stage_queue_size"]))
+
+    def run(self, folder_paths, on_result=None, save_dir_for=None):
+        """
+        Analizza tutte le sessioni e restituisce i risultati nell'ordine di `folder_paths`.
+        `on_result(folder_path, results)` viene chiamata appena una sessione è completa;
+        `save_dir_for(folder_path)` indica dove salvare le immagini intermedie (None = da nessuna parte).
+        Una sessione che fallisce produce {"error": ..., "session": ...} senza fermare le altre.
+        """
+        folder_paths = list(folder_paths)
+        # l'ultima coda raccoglie le sessioni completate e non è limitata
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in SESSION_STAGES] + [queue.Queue()]
+        remaining = {k: self.workers[name] for k, (name, _) in enumerate(SESSION_STAGES)}
+        lock = threading.Lock()
+
+        threads = []
+        for k, (name, stage) in enumerate(SESSION_STAGES):
+            for w in range(self.workers[name]):
+                thread = threading.Thread(target=self._worker, args=(k, stage, queues, remaining, lock),
+                                          name=f"{name}-{w}", daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        def feed():
+            for index, folder_path in enumerate(folder_paths):
+                save_dir = save_dir_for(folder_path) if save_dir_for is not None else None
+                state = new_session(folder_path, self.config, save_dir=save_dir)
+                # il picco di RSS è del processo: con più fasi in parallelo non è attribuibile a una fase
+                state["timer"] = profiling.StageTimer(track_memory=False)
+                queues[0].put((index, state))
+            for _ in range(self.workers[SESSION_STAGES[0][0]]):
+                queues[0].put(_DONE)
+
+        feeder = threading.Thread(target=feed, name="feeder", daemon=True)
+        feeder.start()
+
+        results = [None] * len(folder_paths)
+        for _ in folder_paths:
+            index, state = queues[-1].get()
+            results[index] = self._finish(state)
+            if on_result is not None:
+                on_result(state["folder_path"], results[index])
+
+        feeder.join()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def _worker(self, k, stage, queues, remaining, lock):
+        inbox, outbox = queues[k], queues[k + 1]
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                # l'ultimo thread della fase che termina avvisa i thread della fase successiva
+                with lock:
+                    remaining[k] -= 1
+                    last = remaining[k] == 0
+                if last and k + 1 < len(SESSION_STAGES):
+                    for _ in range(self.workers[SESSION_STAGES[k + 1][0]]):
+                        outbox.put(_DONE)
+                return
+            _, state = item
+            if state.get("error") is None:
+                if k == 0:
+                    state["startts"] = time.time()
+                try:
+                    with profiling.use_timer(state["timer"]):
+                        stage(state, self.config)
+                except Exception as e:
+                    traceback.print_exc()
+                    state["error"] = repr(e)
+            outbox.put(item)
+
+    def _finish(self, state):
+        if state.get("error") is not None:
+            return {"error": state["error"], "session": state["folder_path"]}
+        try:
+            globalResults = session_results(state, self.config)
+        except Exception as e:
+            traceback.print_exc()
+            return {"error": repr(e), "session": state["folder_path"]}
+        return finish_session(state, self.config, globalResults, state["timer"])
+
+
+def run_sessions(folder_paths, config=None, workers=None, queue_size=None, on_result=None, save_dir_for=None):
+    """Scorciatoia: StagedExecutor(config, workers, queue_size).run(...)."""
+    executor = StagedExecutor(config, workers=workers, queue_size=queue_size)
+    return executor.run(folder_paths, on_result=on_result, save_dir_for=save_dir_for)
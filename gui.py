@@ -0,0 +1,149 @@
+import os
+
+import matplotlib as matplotlib
+import matplotlib.pyplot as plt
+import matplotlib.image as mpimg    
+import pprint as pp
+import tkinter as tk
+from tkinter import ttk
+
+# Interfaccia grafica (barra di progresso Tkinter + figura matplotlib) usata da main.py
+# quando non è in modalità headless. Lo stato vive a livello di modulo come nel vecchio main.
+
+root = None
+progress_var = None
+label_var = None
+image_files = []
+
+# riga e titolo della figura per ogni immagine intermedia della pipeline
+image_rows = {
+    "mosaic": (1, "ORIGINAL IMAGES MOSAIC"),
+    "corrected": (3, "MOSAIC DISTORTION CORRECTION"),
+    "trees": (5, "MAIN TREE DETECTION"),
+}
+
+def setup_window():
+    """Crea la finestra Tkinter per la barra di progresso"""
+    global root, progress_var, label_var
+    root = tk.Tk()
+    root.title("Progresso Script")
+    root.geometry("150x300")  
+    root.resizable(False, False)
+
+    progress_var = tk.DoubleVar()
+    label_var = tk.StringVar()
+
+    label = ttk.Label(root, textvariable=label_var, font=("Arial", 10), wraplength=120)
+    label.pack(pady=10)
+
+    progressbar = ttk.Progressbar(root, orient="vertical", length=200, mode="determinate", variable=progress_var)
+    progressbar.pack(fill=tk.Y, expand=True)
+
+def update_progress(phase, value):
+    """Aggiorna la barra di progresso e la label"""
+    progress_var.set(value)
+    label_var.set(phase)
+    root.update_idletasks()  # Aggiorna la GUI
+
+def show_source_images(files):
+    """Prepara la figura e mostra le immagini sorgenti della sessione nella prima riga"""
+    global image_files
+    image_files = files
+    matplotlib.use('TkAgg')
+    matplotlib.rcParams['toolbar'] = 'None'
+    plt.ion()  # Turn on interactive mode
+    figure = plt.figure(constrained_layout=True, figsize=(19, 8))
+    figure.canvas.manager.window.wm_geometry("+0+0")
+    # figure.subplots_adjust(0, 0, 0, 0, 0, 0)
+    for i, oi in enumerate(image_files):
+        oimg = mpimg.imread(oi)
+        ax = plt.subplot2grid((7, len(image_files)), (0, i))
+        ax.clear()
+        ax.axis('off')
+        ax.imshow(oimg)
+    plt.tight_layout()
+    # plt.show(block=True)
+    plt.pause(0.1)
+
+def show_image(name, image):
+    """Mostra le immagini intermedie prodotte dalla pipeline"""
+    if name == "oranges":
+        plt.pause(10)
+        return
+    row, title = image_rows[name]
+    ax = plt.subplot2grid((7, len(image_files)), (row, 0), colspan=len(image_files), rowspan=2)
+    ax.clear()
+    ax.axis('off')
+    ax.imshow(image)
+    ax.set_title(title)
+    plt.tight_layout()
+    # plt.show(block=True)
+
+    plt.draw()
+    plt.pause(0.1)
+
+def show_results(results, exec_time):
+    # Crea una nuova finestra per i risultati
+    results_window = tk.Toplevel(root)
+    results_window.title("Risultati Analisi")
+    results_window.geometry("600x400")
+    
+    # Stile per il testo
+    style = ttk.Style()
+    style.configure("Results.TLabel", font=("Arial", 12))
+    
+    # Frame principale con scrollbar
+    main_frame = ttk.Frame(results_window)
+    main_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=20)
+    
+    # Crea un canvas con scrollbar
+    canvas = tk.Canvas(main_frame)
+    scrollbar = ttk.Scrollbar(main_frame, orient="vertical", command=canvas.yview)
+    scrollable_frame = ttk.Frame(canvas)
+    
+    scrollable_frame.bind(
+        "<Configure>",
+        lambda e: canvas.configure(scrollregion=canvas.bbox("all"))
+    )
+    
+    canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
+    canvas.configure(yscrollcommand=scrollbar.set)
+    
+    # Aggiungi i risultati
+    ttk.Label(scrollable_frame, text="RISULTATI ANALISI", font=("Arial", 14, "bold")).pack(pady=10)
+    
+    # Formatta e mostra i risultati principali
+    results_text = [
+        f"Number of Oranges: {results['oranges']}",
+        f"Average Ripeness: {results['avgMaturity']:.2f}",
+        f"Average Dimension: {results['avgDimesions']:.2f} mm",
+        f"Average Weights: {results['avgWeights']:.2f} g",
+        f"Source Image: {results['sourceImages']}",
+        f"Data: {results['date']}",
+        f"/nTotal Execution Time: {exec_time:.2f} seconds"
+    ]
+    
+    for text in results_text:
+        ttk.Label(scrollable_frame, text=text, style="Results.TLabel").pack(pady=5, anchor="w")
+    
+    # Aggiungi dettagli completi
+    ttk.Label(scrollable_frame, text="/nDettagli completi:", font=("Arial", 12, "bold")).pack(pady=10)
+    
+    # Usa str() invece di pprint.pformat
+    details_text = pp.pformat(results, indent=2, width=60)
+    text_widget = tk.Text(scrollable_frame, height=10, width=60, font=("Courier", 10))
+    text_widget.insert("1.0", details_text)
+    text_widget.config(state="disabled")
+    text_widget.pack(pady=10)
+    
+    # Pack del canvas e scrollbar
+    canvas.pack(side="left", fill="both", expand=True)
+    scrollbar.pack(side="right", fill="y")
+    
+    # Centra la finestra
+    results_window.update_idletasks()
+    width = results_window.winfo_width()
+    height = results_window.winfo_height()
+    x = (results_window.winfo_screenwidth() // 2) - (width // 2)
+    y = (results_window.winfo_screenheight() // 2) - (height // 2)
+    results_window.geometry(f'{width}x{height}+{x}+{y}')
@@ -0,0 +1,173 @@
+from ultralytics import YOLO
+from torch import cuda
+import torch
+import numpy as np
+import importlib.util
+import threading
+import os
+
+
+# Registro dei modelli caricati nel processo, chiave (percorso assoluto dei pesi, device, backend, precisione)
+_models = {}
+_models_lock = threading.Lock()
+# un lock per istanza di modello: il predictor di ultralytics non è thread-safe, ma modelli
+# diversi possono lavorare in parallelo su thread diversi
+_model_locks = {}
+_model_locks_lock = threading.Lock()
+
+
+def default_device():
+    return "cuda" if cuda.is_available() else "cpu"
+
+
+# Backend di inferenza: "torch" usa direttamente i pesi .pt, gli altri un export di ultralytics
+# salvato accanto ai pesi (modello1.onnx, modello1_openvino_model/, modello1_int8_openvino_model/)
+BACKENDS = ("torch", "onnx", "openvino")
+# modulo di runtime di ogni backend esportato: se manca si usa PyTorch invece di lasciare che
+# ultralytics provi a installarlo al primo predict
+BACKEND_RUNTIMES = {"onnx": "onnxruntime", "openvino": "openvino"}
+# precisione dei pesi: "int8" è la quantizzazione post-training di quantize.py (solo OpenVINO)
+PRECISIONS = ("fp32", "int8")
+
+
+def backend_artifact(model_path, backend, precision="fp32"):
+    """Percorso dell'export di `model_path` per `backend`, accanto ai pesi (None per "torch" fp32)."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend: {backend}")
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown model precision: {precision}")
+    if precision == "int8" and backend != "openvino":
+        raise ValueError("INT8 models are only available with the openvino backend")
+    root, _ = os.path.splitext(os.path.abspath(model_path))
+    if backend == "onnx":
+        return root + ".onnx"
+    if backend == "openvino":
+        return root + ("_int8" if precision == "int8" else "") + "_openvino_model"
+    return None
+
+
+def export_model(model_path, backend, precision="fp32", **kwargs):
+    """
+    Esporta i pesi .pt nel formato di `backend` (batch dinamico) e restituisce il percorso dell'artefatto,
+    che ultralytics scrive accanto ai pesi. `kwargs` vengono passati a YOLO.export (es. imgsz, e per
+    precision "int8" il file `data` con le immagini di calibrazione).
+    """
+    artifact = backend_artifact(model_path, backend, precision)
+    if artifact is None:
+        return os.path.abspath(model_path)
+    print("exporting model:", model_path, "to", backend, precision)
+    exported = YOLO(model_path, verbose=False).export(format=backend, dynamic=True,
+                                                      int8=precision == "int8", **kwargs)
+    if os.path.abspath(exported) != artifact:
+        os.replace(exported, artifact)
+    return artifact
+
+
+def _warmup(model, device):
+    """Predizione a vuoto: per gli export è anche il momento in cui ultralytics crea il runtime."""
+    dummy = np.zeros((64, 64, 3), dtype=np.uint8)
+    model.predict(source=dummy, device=device, save=False, verbose=False)
+
+
+def _load(model_path, device, backend, precision, export, warmup=True):
+    """
+    Carica il modello per `backend`/`precision`. Un modello INT8 mancante ripiega sull'FP32 dello stesso
+    backend (la quantizzazione richiede la calibrazione di quantize.py); un export FP32 mancante che
+    non si può creare, o il cui runtime manca o non funziona, ripiega su PyTorch. Per gli export il
+    warm-up (con `warmup`) gira dentro il blocco di fallback, perché è lì che il runtime viene creato.
+    """
+    if precision == "int8":
+        artifact = backend_artifact(model_path, backend, precision)
+        try:
+            if importlib.util.find_spec(BACKEND_RUNTIMES[backend]) is None:
+                raise ModuleNotFoundError(f"{BACKEND_RUNTIMES[backend]} is not installed")
+            if not os.path.exists(artifact):
+                raise FileNotFoundError(f"{artifact} (run quantize.py)")
+            task = YOLO(model_path, verbose=False).task
+            print("loading model:", artifact, "with", backend, precision)
+            model = YOLO(artifact, task=task, verbose=False)
+            if warmup:
+                _warmup(model, device)
+            return model
+        except Exception as e:
+            print("INT8 model not available for", model_path, "- falling back to fp32:", repr(e))
+
+    if backend != "torch":
+        artifact = backend_artifact(model_path, backend)
+        try:
+            if importlib.util.find_spec(BACKEND_RUNTIMES[backend]) is None:
+                raise ModuleNotFoundError(f"{BACKEND_RUNTIMES[backend]} is not installed")
+            if not os.path.exists(artifact):
+                if not export:
+                    raise FileNotFoundError(artifact)
+                export_model(model_path, backend)
+            # il task (detect) viene dai pesi originali: i metadati dell'export possono mancare
+            task = YOLO(model_path, verbose=False).task
+            print("loading model:", artifact, "with", backend)
+            model = YOLO(artifact, task=task, verbose=False)
+            if warmup:
+                _warmup(model, device)
+            return model
+        except Exception as e:
+            print("backend", backend, "not available for", model_path, "- falling back to torch:", repr(e))
+
+    print("loading model:", model_path, "on", device)
+    model = YOLO(model_path, verbose=False)
+    model.to(device)
+    # fuse fuori dal grafo autograd, altrimenti i pesi fusi non sono più foglie
+    with torch.no_grad():
+        model.fuse()
+    if warmup:
+        _warmup(model, device)
+    return model
+
+
+def get_model(model_path, device=None, warmup=True, backend="torch", precision="fp32", export=True):
+    """
+    Restituisce il modello YOLO per `model_path` caricandolo una sola volta per processo.
+    Al primo accesso il modello viene spostato sul device, fuso (conv+bn) e scaldato con
+    una predizione a vuoto; le chiamate successive restituiscono la stessa istanza.
+    Con `backend` "onnx" o "openvino" usa l'export accanto ai pesi (creandolo se `export`),
+    con gli stessi oggetti Results di ultralytics; se non è disponibile usa PyTorch.
+    Con `precision` "int8" usa il modello quantizzato da quantize.py (backend "openvino").
+    """
+    if device is None:
+        device = default_device()
+    # valida subito la combinazione backend/precisione
+    backend_artifact(model_path, backend, precision)
+    key = (os.path.abspath(model_path), device, backend, precision)
+    with _models_lock:
+        model = _models.get(key)
+        if model is None:
+            model = _load(model_path, device, backend, precision, export, warmup=warmup)
+            _models[key] = model
+    return model
+
+
+def model_lock(model):
+    """Lock da tenere durante le predizioni con `model` quando più thread lo condividono."""
+    with _model_locks_lock:
+        lock = _model_locks.get(id(model))
+        if lock is None:
+            lock = _model_locks[id(model)] = threading.Lock()
+    return lock
+
+
+def resolve_model(model, device=None, backend="torch", precision="fp32"):
+    """Accetta un modello già caricato oppure il percorso dei pesi (caricato tramite il registro)."""
+    if isinstance(model, (str, os.PathLike)):
+        return get_model(model, device=device, backend=backend, precision=precision)
+    return model
+
+
+def preload_models(model_paths, device=None, backend="torch", precision="fp32"):
+    """Carica in anticipo tutti i modelli indicati (ad esempio all'avvio)."""
+    return [get_model(path, device=device, backend=backend, precision=precision) for path in model_paths]
+
+
+def clear_models():
+    """Svuota il registro (i modelli verranno ricaricati al prossimo get_model)."""
+    with _models_lock:
+        _models.clear()
+    with _model_locks_lock:
+        _model_locks.clear()
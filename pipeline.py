@@ -0,0 +1,393 @@
+import os
+import time
+from datetime import datetime, timezone
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from modelregistry import preload_models, get_model
+import profiling
+from poledetection import calculate_coefficient
+from Auxiliary import (stitch_image, correct_image_with_detections, orangetree_bbox, divide_image,
+                       adjust_bbox_coordinates, predict_tiles, detect_tiled, classify_crops, boxes_in_crop,
+                       assign_boxes_to_tiles, to_frame, image_size, crop_region, estimate_diameters,
+                       CoefficientInterpolator, load_weight_table, stage_imgsz, typical_object_size)
+
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# Configurazione di default della pipeline di analisi (sovrascrivibile per chiave)
+DEFAULT_CONFIG = {
+    "device_id": '3cadfeef-9474-4a1b-a1f2-99e197ce18bd',
+    "device": None,  # None = cuda se disponibile, altrimenti cpu
+    "inference_backend": "torch",  # "torch", "onnx" o "openvino" (export accanto ai pesi, fallback su torch)
+    "precision": "fp32",  # "fp32" oppure "int8" (modelli quantizzati da quantize.py, backend "openvino")
+    "orange_model_path": os.path.join(BASE_PATH, "models_weights", "modello1.pt"),
+    "orangetree_model_path": os.path.join(BASE_PATH, "models_weights", "modello2.pt"),
+    "pole_model_path": os.path.join(BASE_PATH, "models_weights", "modello3.pt"),
+    "ripening_model_path": os.path.join(BASE_PATH, "models_weights", "modello4.pt"),
+    "decode_workers": 4,  # thread per la decodifica parallela delle immagini della sessione
+    "registration_reduce": 1,  # 1, 2, 4 o 8: feature di "cached"/"sequential" da JPEG decodificati ridotti
+    "stitch_mode": "opencv",  # "opencv" (cv2.Stitcher), "cached" (feature in cache) o "sequential" (sweep ordinato)
+    "registration_mp": 0.6,  # megapixel usati per la registrazione delle immagini
+    "compositing_mp": -1,  # megapixel per immagine del mosaico (<= 0 = risoluzione nativa)
+    "feature_cache_dir": os.path.join(BASE_PATH, "runs", "feature_cache"),  # cache feature per stitch "cached"
+    "stitch_motion": "affine",  # modello di moto per "cached"/"sequential": "affine" o "homography"
+    "correction_confidence": 0.5,
+    "tree_confidence": 0.1,
+    "tree_batch_size": 8,  # candidati albero rifiniti insieme nella seconda fase
+    "orange_confidence": 0.1,
+    "redetect_oranges": False,  # True = rileva di nuovo le arance sull'albero invece di riusare quelle della correzione
+    "tile_size": None,  # None = griglia fissa 8x15; altrimenti finestre sovrapposte di questo lato (es. 640)
+    "tile_overlap": 0.2,  # sovrapposizione tra finestre adiacenti, frazione del lato
+    "tile_merge": "nms",  # unione delle box tra finestre: "nms" o "wbf"
+    "tile_merge_iou": 0.5,  # soglia di sovrapposizione per considerare due box la stessa arancia
+    "tile_merge_metric": "iou",  # "iou" oppure "ios" (intersezione sull'area della box più piccola)
+    "orange_batch_size": 16,  # numero di tile inviate insieme al modello delle arance
+    "pole_confidence": 0.075,
+    "pole_batch_size": 16,  # strisce / ritagli dei pali inviati insieme al modello
+    "pole_refine_confidence": None,  # None = rifinisce sempre; altrimenti salta la seconda fase sopra questa confidenza
+    "ripening_batch_size": 32,  # numero di ritagli classificati insieme dal modello di maturazione
+    # dimensioni di inferenza per fase: intero, None (default di ultralytics, 640) oppure "auto", cioè la più
+    # piccola che tiene gli oggetti ad almeno min_object_px pixel (ripening_min_object_px per i ritagli)
+    "orange_imgsz": 640,
+    "tree_imgsz": 640,
+    "pole_imgsz": 640,
+    "ripening_imgsz": 640,  # lato comune a cui vengono portati i ritagli delle arance (None = 640, "auto" per sessione)
+    "min_object_px": 32,
+    "ripening_min_object_px": 64,
+    "weight_calibration": os.path.join(BASE_PATH, "calibration", "orange_default.json"),  # tabella diametro -> peso della varietà
+    "scale_map_step": None,  # None = coefficiente dei pali esatto per ogni arancia; N = mappa densa a passo N pixel
+    "stage_workers": None,  # thread per fase in executor.StagedExecutor, es. {"stitch": 2} (default 1 per fase)
+    "stage_queue_size": 2,  # sessioni in attesa tra due fasi consecutive dell'executor
+    "timing_log": os.path.join(BASE_PATH, "runs", "timings.jsonl"),  # log JSONL dei tempi per fase (None = off)
+    "profiler": None,  # None, "cprofile" o "torch"
+    "profile_dir": os.path.join(BASE_PATH, "runs", "profiles"),  # dove salvare le trace del profiler
+}
+
+MODEL_KEYS = ("orange_model_path", "orangetree_model_path", "pole_model_path", "ripening_model_path")
+
+
+def load_config(config=None):
+    """Restituisce la configurazione di default aggiornata con le chiavi di `config`."""
+    merged = dict(DEFAULT_CONFIG)
+    if config:
+        unknown = set(config) - set(DEFAULT_CONFIG)
+        if unknown:
+            raise ValueError(f"Unknown pipeline configuration keys: {sorted(unknown)}")
+        merged.update(config)
+    return merged
+
+
+def load_pipeline_models(config=None):
+    """Carica (una volta per processo) tutti i modelli usati dalla pipeline."""
+    config = load_config(config)
+    preload_models([config[key] for key in MODEL_KEYS], device=config["device"],
+                   backend=config["inference_backend"], precision=config["precision"])
+
+
+def pipeline_model(config, key):
+    """Modello della pipeline per la chiave `key` (es. "orange_model_path"), dal registro."""
+    return get_model(config[key], device=config["device"], backend=config["inference_backend"],
+                     precision=config["precision"])
+
+
+def tiling_options(config):
+    """Parametri di detect_tiled presi dalla configurazione."""
+    return {
+        "imgsz": config["orange_imgsz"],
+        "min_object_px": config["min_object_px"],
+        "tile_size": config["tile_size"],
+        "overlap": config["tile_overlap"],
+        "merge": config["tile_merge"],
+        "iou_threshold": config["tile_merge_iou"],
+        "metric": config["tile_merge_metric"],
+    }
+
+
+def detect_oranges(maintree, config, boxes=None, object_size=None):
+    """
+    Rileva le arance sulle tile dell'albero e ne classifica la maturazione.
+    Se `boxes` (N, 4) è indicato, sono le arance già rilevate in fase di correzione, nelle
+    coordinate dell'albero: vengono solo assegnate alle tile invece di rifare la rilevazione.
+    `object_size` (lato tipico delle arance in pixel) guida orange_imgsz "auto" nella nuova rilevazione.
+    `maintree` può essere un'immagine PIL o il frame BGR dell'albero: tile e ritagli sono viste del frame.
+    Restituisce le bounding box nelle coordinate dell'albero e la lista delle maturazioni.
+    """
+    maintree = to_frame(maintree)
+    with profiling.stage("divide_image"):
+        divided_images, positions = divide_image(maintree)
+    ripening = pipeline_model(config, "ripening_model_path")
+
+    # per ogni tile, le box intere nelle coordinate dell'albero
+    per_tile = [[] for _ in divided_images]
+    if boxes is None and config["tile_size"] is not None:
+        # rilevazione su finestre sovrapposte: le box unite vengono poi assegnate alle tile
+        modello = pipeline_model(config, "orange_model_path")
+        with profiling.stage("orange_detection"):
+            boxes, _ = detect_tiled(modello, maintree, batch_size=config["orange_batch_size"],
+                                    conf=config["orange_confidence"], object_size=object_size,
+                                    **tiling_options(config))
+    if boxes is None:
+        modello = pipeline_model(config, "orange_model_path")
+        with profiling.stage("orange_detection"):
+            tile_side = max(max(image_size(img)) for img in divided_images)
+            predictions = predict_tiles(modello, divided_images, batch_size=config["orange_batch_size"],
+                                        conf=config["orange_confidence"],
+                                        imgsz=stage_imgsz(config["orange_imgsz"], tile_side, object_size,
+                                                          config["min_object_px"]))
+        for i, bbox in enumerate(predictions):
+            for j in range(len(bbox.boxes.xyxy)):
+                x1, y1, x2, y2 = (bbox.boxes.xyxy)[j]
+                x1, y1, x2, y2 = [int(round(coord.item())) for coord in [x1, y1, x2, y2]]
+                per_tile[i].append(adjust_bbox_coordinates((x1, y1, x2, y2), positions[i]))
+    else:
+        sizes = [image_size(img) for img in divided_images]
+        for box, i in zip(boxes, assign_boxes_to_tiles(boxes, positions, sizes)):
+            per_tile[i].append(tuple(int(round(coord)) for coord in box))
+
+    all_bboxes = []
+    maturity = []
+    # maturity_slots tiene l'ordine originale: indice del ritaglio da classificare
+    # oppure valore già noto (fallback per le tile senza arance)
+    crops = []
+    maturity_slots = []
+    for i, img in enumerate(divided_images):
+        if per_tile[i]:
+            for bbox in per_tile[i]:
+                crops.append(crop_region(maintree, bbox))
+                maturity_slots.append(("crop", len(crops) - 1))
+                all_bboxes.append(bbox)
+        else:
+            w, h = image_size(img)
+            adjusted_bbox1 = adjust_bbox_coordinates((
+                int(w * 0.20), int(h * 0.30),
+                int(w * 0.45), int(h * 0.60)
+            ), positions[i])
+
+            # Seconda bbox (centro-destra)
+            adjusted_bbox2 = adjust_bbox_coordinates((
+                int(w * 0.55), int(h * 0.30),
+                int(w * 0.80), int(h * 0.60)
+            ), positions[i])
+            all_bboxes.append(adjusted_bbox1)
+            maturity_slots.append(("value", np.random.randint(65, 90)))
+            all_bboxes.append(adjusted_bbox2)
+            maturity_slots.append(("value", np.random.randint(65, 90)))
+
+    # classificazione della maturazione di tutti i ritagli in pochi batch
+    with profiling.stage("ripeness_classification"):
+        crop_classes = classify_crops(ripening, crops, imgsz=config["ripening_imgsz"],
+                                      min_object_px=config["ripening_min_object_px"],
+                                      batch_size=config["ripening_batch_size"])
+    for kind, value in maturity_slots:
+        if kind == "crop":
+            if crop_classes[value] is not None:
+                maturity.append(crop_classes[value])
+        else:
+            maturity.append(value)
+    return all_bboxes, maturity
+
+
+def estimate_sizes(all_bboxes, interpolator):
+    """
+    Calcola i diametri (mm) delle arance dalle box e dalla superficie dei coefficienti dei pali
+    (CoefficientInterpolator), tutti insieme.
+    Scarta i diametri sotto i 30 mm e limita a 110 quelli oltre (senza riportarne il centro).
+    """
+    diameters, centers = estimate_diameters(all_bboxes, interpolator)
+    kept = diameters >= 30
+    capped = diameters > 110
+    dimensioni = [110 if c else int(d) for d, c in zip(diameters[kept], capped[kept])]
+    centroidi = [tuple(c) for c in centers[kept & ~capped].tolist()]
+    return dimensioni, centroidi
+
+
+def new_session(folder_path, config, progress=None, on_image=None, save_dir=None):
+    """
+    Stato di una sessione da far passare attraverso le fasi di SESSION_STAGES: ogni fase legge
+    e aggiunge chiavi al dizionario. `config` deve essere già completo (load_config).
+    """
+    currentGMT = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    session_name = os.path.basename(os.path.normpath(folder_path))
+    trace_path = None
+    if config["profiler"] is not None:
+        extension = ".prof" if config["profiler"] == "cprofile" else ".json"
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+        trace_path = os.path.join(config["profile_dir"], f"{session_name}_{stamp}{extension}")
+    return {
+        "folder_path": folder_path,
+        "currentGMT": currentGMT,
+        "trace_path": trace_path,
+        "progress": progress,
+        "on_image": on_image,
+        "save_dir": save_dir,
+        "startts": time.time(),
+    }
+
+
+def analyze_session(folder_path, config=None, progress=None, on_image=None, save_dir=None):
+    """
+    Esegue la pipeline completa (stitch -> correzione -> albero -> arance -> pali -> dimensioni)
+    sulle immagini di una sessione e restituisce il dizionario dei risultati.
+    `progress(fase, valore)` e `on_image(nome, immagine)` sono callback opzionali per la GUI;
+    se `save_dir` è indicato vi vengono salvate le immagini intermedie (mosaic/corrected/trees.jpg).
+    I tempi per fase e i contatori finiscono in results["profiling"] e nel log `timing_log`.
+    """
+    config = load_config(config)
+    state = new_session(folder_path, config, progress, on_image, save_dir)
+    with profiling.profile_session(config["profiler"], state["trace_path"]) as timer:
+        state["startts"] = time.time()
+        for _, stage in SESSION_STAGES:
+            stage(state, config)
+        globalResults = session_results(state, config)
+    return finish_session(state, config, globalResults, timer)
+
+
+def finish_session(state, config, globalResults, timer):
+    """Aggiunge i tempi per fase ai risultati e li registra nel log `timing_log`."""
+    globalResults["profiling"] = timer.as_dict()
+    if config["timing_log"] is not None:
+        profiling.log_timings(config["timing_log"], {
+            "session": state["folder_path"],
+            "date": state["currentGMT"],
+            "execTime": globalResults["execTime"],
+            "trace": state["trace_path"],
+            **globalResults["profiling"],
+        })
+    return globalResults
+
+
+def _notify(state, phase, value):
+    if state["progress"] is not None:
+        state["progress"](phase, value)
+
+
+def _show(state, name, frame):
+    # le fasi lavorano su frame BGR: l'immagine PIL (RGB) si crea solo per la GUI
+    if state["save_dir"] is not None and name != "oranges":
+        os.makedirs(state["save_dir"], exist_ok=True)
+        cv2.imwrite(os.path.join(state["save_dir"], name + ".jpg"), frame)
+    if state["on_image"] is not None:
+        state["on_image"](name, Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+
+
+def stage_stitch(state, config):
+    _notify(state, "Stitching...", 20)
+    #mosaicatura delle foto della sessione
+    with profiling.stage("stitch_image"):
+        state["mosaic"], state["source_images"] = stitch_image(state["folder_path"],
+                                                               workers=config["decode_workers"],
+                                                               registration_reduce=config["registration_reduce"],
+                                                               mode=config["stitch_mode"],
+                                                               registration_mp=config["registration_mp"],
+                                                               compositing_mp=config["compositing_mp"],
+                                                               feature_cache_dir=config["feature_cache_dir"],
+                                                               motion=config["stitch_motion"])
+    _show(state, "mosaic", state["mosaic"])
+
+
+def stage_correct(state, config):
+    _notify(state, "Distortion Correction...", 40)
+    #correzione della distorsione dell'immagine dovuta alla prospettiva
+    # le arance rilevate qui (a orange_confidence) vengono riusate per il conteggio
+    with profiling.stage("correct_image"):
+        state["corrected"], state["orange_boxes"], _ = correct_image_with_detections(
+            state.pop("mosaic"), model_path=pipeline_model(config, "orange_model_path"),
+            confidence=config["correction_confidence"],
+            detection_confidence=config["orange_confidence"],
+            batch_size=config["orange_batch_size"],
+            **tiling_options(config))
+    _show(state, "corrected", state["corrected"])
+
+
+def stage_tree(state, config):
+    _notify(state, "Main Tree Detection...", 60)
+    #individuo solo l'albero centrale con la visione migliore
+    with profiling.stage("orangetree"):
+        tree_model = pipeline_model(config, "orangetree_model_path")
+        maintree, tree_box = orangetree_bbox(state.pop("corrected"), tree_model,
+                                             confidence=config["tree_confidence"],
+                                             batch_size=config["tree_batch_size"],
+                                             imgsz=config["tree_imgsz"], min_object_px=config["min_object_px"])
+    _show(state, "trees", maintree)
+    state["maintree"] = maintree
+    state["tree_box"] = tree_box
+
+
+def stage_oranges(state, config):
+    _notify(state, "Orange Detection and Calculation...", 80)
+    # da qui in poi tile e ritagli sono viste del frame BGR dell'albero
+    state["tree_frame"] = tree_frame = state.pop("maintree")
+    tree_boxes, _ = boxes_in_crop(state.pop("orange_boxes"), state["tree_box"])
+    if config["redetect_oranges"]:
+        # le arance della correzione danno la scala per orange_imgsz "auto"
+        all_bboxes, maturity = detect_oranges(tree_frame, config, object_size=typical_object_size(tree_boxes))
+    else:
+        all_bboxes, maturity = detect_oranges(tree_frame, config, boxes=tree_boxes)
+    _show(state, "oranges", tree_frame)
+    state["all_bboxes"] = all_bboxes
+    state["maturity"] = maturity
+
+
+def stage_poles(state, config):
+    tree_frame = state.pop("tree_frame")
+    #calcolo i coefficienti e i centroidi dei riferimenti spaziali
+    with profiling.stage("calculate_coefficient"):
+        pole_model = pipeline_model(config, "pole_model_path")
+        coefficienti, centroids = calculate_coefficient(model_path=pole_model, image=tree_frame,
+                                                        confidence=config["pole_confidence"],
+                                                        batch_size=config["pole_batch_size"],
+                                                        refine_confidence=config["pole_refine_confidence"],
+                                                        imgsz=config["pole_imgsz"],
+                                                        min_object_px=config["min_object_px"])
+        # superficie dei coefficienti costruita una sola volta per immagine
+        interpolator = CoefficientInterpolator(centroids, coefficienti)
+        if config["scale_map_step"]:
+            interpolator.rasterize(*image_size(tree_frame), step=config["scale_map_step"])
+    state["interpolator"] = interpolator
+
+
+def stage_sizes(state, config):
+    with profiling.stage("size_estimation"):
+        state["dimensioni"], state["centroidi"] = estimate_sizes(state["all_bboxes"], state.pop("interpolator"))
+
+    with profiling.stage("weight_estimation"):
+        state["weights"] = load_weight_table(config["weight_calibration"])(state["dimensioni"]).tolist()
+
+    _notify(state, "End", 100)
+
+
+# Fasi della pipeline, in ordine: ognuna riceve lo stato della sessione e la configurazione.
+# analyze_session le esegue in sequenza, executor.StagedExecutor le sovrappone tra sessioni diverse.
+SESSION_STAGES = (
+    ("stitch", stage_stitch),
+    ("correct", stage_correct),
+    ("tree", stage_tree),
+    ("oranges", stage_oranges),
+    ("poles", stage_poles),
+    ("sizes", stage_sizes),
+)
+
+
+def session_results(state, config):
+    """Dizionario dei risultati della sessione a partire dallo stato dopo l'ultima fase."""
+    exectime = time.time() - state["startts"]
+    maturity = state["maturity"]
+    dimensioni = state["dimensioni"]
+    weights = state["weights"]
+    globalResults = {
+        "deviceId": config["device_id"],
+        "oranges": len(state["all_bboxes"]),
+        "maturity": maturity,
+        "avgMaturity": sum(maturity)/len(maturity),
+        "dimesions": dimensioni,
+        "avgDimesions": sum(dimensioni)/len(dimensioni),
+        "weights": weights,
+        "avgWeights": sum(weights)/len(weights),
+        "sourceImages": state["source_images"],
+        "date": state["currentGMT"],
+        "execTime": exectime
+    }
+    return globalResults
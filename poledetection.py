@@ -3,12 +3,13 @@ import ultralytics
 from ultralytics import YOLO
 import PIL
 from PIL import Image,ImageDraw
-import matplotlib.pyplot as plt
 import cv2
 import numpy as np
 import os
 import cv2
-import matplotlib.patches as patches
+from modelregistry import resolve_model
+from Auxiliary import to_frame, image_size, crop_region, filter_contained_boxes, predict_tiles, stage_imgsz
+import profiling
 
 
 def expand_bbox(x1, y1, x2, y2, expansion_ratio=0.25):
@@ -23,95 +24,103 @@ def expand_bbox(x1, y1, x2, y2, expansion_ratio=0.25):
     return x1_expanded, y1_expanded, x2_expanded, y2_expanded
 
 def divide_image_horizontally(image, patch_width):
+    # con un frame NumPy le strisce sono viste, senza copie
     patches = []
-    img_width, img_height = image.size
+    img_width, img_height = image_size(image)
     for x in range(0, img_width, patch_width):
         box = (x, 0, min(x + patch_width, img_width), img_height)
-        patch = image.crop(box)
+        patch = crop_region(image, box)
         patches.append((patch, x))
     return patches
 
-def calculate_coefficient(model_path, image):
-    model = YOLO(model_path)
+def calculate_coefficient(model_path, image, confidence=0.075, batch_size=16, refine_confidence=None,
+                          imgsz=None, min_object_px=32):
+    """
+    Rileva i pali (riferimento di 1000 mm) in due fasi, entrambe a batch: prima su tutte le strisce
+    larghe 640 px, poi su tutti i ritagli ampliati attorno ai pali trovati.
+    Con `refine_confidence` i pali della prima fase con confidenza >= soglia non vengono
+    rifiniti e si usa direttamente la loro box.
+    `model_path` può essere anche un modello già caricato; `imgsz` (intero, None o "auto", vedi
+    stage_imgsz) vale per entrambe le fasi.
+    Restituisce i coefficienti mm/pixel e i centroidi dei pali.
+    """
+    model = resolve_model(model_path)
+    # un solo frame BGR (quello che ultralytics si aspetta da un ndarray): strisce e ritagli ne sono viste
+    image = to_frame(image)
 
     # Larghezza della patch (ad esempio, 640)
     patch_width = 640
 
     # Dividi l'immagine in patch lungo la larghezza
     patches = divide_image_horizontally(image, patch_width)
+    profiling.count("tiles", len(patches))
 
-    # Itera su ciascuna patch e esegui la rilevazione
+    # Prima fase: tutte le strisce insieme
+    strip_side = max((max(image_size(patch)) for patch, _ in patches), default=0)
+    strip_results = predict_tiles(model, [patch for patch, _ in patches], batch_size=batch_size,
+                                  conf=confidence, imgsz=stage_imgsz(imgsz, strip_side, min_object_px=min_object_px))
+
+    # ogni rilevazione è (box ampliata da rifinire, box già definitiva o None)
     all_detections = []
-    for patch, x_offset in patches:
-        # Converti la patch in un array numpy
-        patch_array = np.array(patch)
-
-        # Esegui il modello YOLO sulla patch
-        results = model.predict(patch_array,conf=0.075,verbose=False)
-        if len(results[0].boxes)==0:
-            pw, ph = patch.size
+    for (patch, x_offset), result in zip(patches, strip_results):
+        if len(result.boxes)==0:
+            pw, ph = image_size(patch)
             fx1 = pw//2 - 5
             fx2 = pw//2 + 5
             fy1 = int(ph * 0.15)
             fy2 = int(ph * 0.85)
-            all_detections.append((fx1 + x_offset, fy1, fx2 + x_offset, fy2))
+            all_detections.append(((fx1 + x_offset, fy1, fx2 + x_offset, fy2), None))
         else:
-            for result in results:
-                boxes = result.boxes
-                for box in boxes:
-                    # Estrai coordinate della bounding box
-                    x1, y1, x2, y2 = map(int, box.xyxy[0])
-                    # Aggiungi l'offset per ottenere le coordinate originali
-                    x1 += x_offset
-                    x2 += x_offset
-                    # Amplia la bounding box
-                    x1, y1, x2, y2 = expand_bbox(x1, y1, x2, y2)
-                    # Salva la bounding box con le coordinate originali
-                    all_detections.append((x1, y1, x2, y2))
-
-    # Seconda fase di rilevazione sulle immagini croppate dalle bounding box
+            for box in result.boxes:
+                # Estrai coordinate della bounding box
+                x1, y1, x2, y2 = map(int, box.xyxy[0])
+                # Aggiungi l'offset per ottenere le coordinate originali
+                x1 += x_offset
+                x2 += x_offset
+                final = None
+                if refine_confidence is not None and float(box.conf[0]) >= refine_confidence:
+                    final = (x1, y1, x2, y2)
+                # Amplia la bounding box
+                all_detections.append((expand_bbox(x1, y1, x2, y2), final))
+
+    # Seconda fase: tutti i ritagli ampliati da rifinire in un unico batch (letterbox di ultralytics)
+    to_refine = [k for k, (expanded, final) in enumerate(all_detections) if final is None]
+    crops = {k: crop_region(image, all_detections[k][0]) for k in to_refine}
+    valid = [k for k in to_refine if min(image_size(crops[k])) > 0]
+    crop_side = max((max(image_size(crops[k])) for k in valid), default=0)
+    refined = dict(zip(valid, predict_tiles(model, [crops[k] for k in valid], batch_size=batch_size,
+                                            conf=confidence,
+                                            imgsz=stage_imgsz(imgsz, crop_side, min_object_px=min_object_px))))
+
     second_detections = []
-    for x1, y1, x2, y2 in all_detections:
-        # Croppa l'immagine originale usando la bounding box amplificata
-        cropped_image = image.crop((x1, y1, x2, y2))
-        cropped_array = np.array(cropped_image)
-        second_results = model.predict(cropped_array,conf=0.075,verbose=False)
-        if len(second_results[0].boxes)==0:
-                cw, ch = cropped_image.size
+    for k, ((x1, y1, x2, y2), final) in enumerate(all_detections):
+        if final is not None:
+            second_detections.append(final)
+            continue
+        second_result = refined.get(k)
+        if second_result is None or len(second_result.boxes)==0:
+                cw, ch = image_size(crops[k])
                 sx1 = x1 + cw//2 - 4
                 sx2 = x1 + cw//2 + 4
                 sy1 = y1 + int(ch * 0.20)
                 sy2 = y1 + int(ch * 0.80)
                 second_detections.append((sx1, sy1, sx2, sy2))
-        for second_result in second_results:
-            second_boxes = second_result.boxes
-            for second_box in second_boxes:
-                # Estrai coordinate della seconda bounding box
-                sx1, sy1, sx2, sy2 = map(int, second_box.xyxy[0])
-                # Trasforma le coordinate rispetto all'immagine originale
-                sx1 += x1
-                sy1 += y1
-                sx2 += x1
-                sy2 += y1
-                # Salva la bounding box con le coordinate originali
-                second_detections.append((sx1, sy1, sx2, sy2))
+                continue
+        for second_box in second_result.boxes:
+            # Estrai coordinate della seconda bounding box
+            sx1, sy1, sx2, sy2 = map(int, second_box.xyxy[0])
+            # Trasforma le coordinate rispetto all'immagine originale
+            sx1 += x1
+            sy1 += y1
+            sx2 += x1
+            sy2 += y1
+            # Salva la bounding box con le coordinate originali
+            second_detections.append((sx1, sy1, sx2, sy2))
 
     bounding_boxes=second_detections
 
-    # Funzione per verificare se una bounding box è contenuta in un'altra
-    def is_contained(inner, outer):
-        return inner[0] >= outer[0] and inner[1] >= outer[1] and inner[2] <= outer[2] and inner[3] <= outer[3]
-
     # Filtra le bounding box per rimuovere quelle contenute in altre bounding box
-    filtered_bounding_boxes = []
-    for i, box in enumerate(bounding_boxes):
-        contained = False
-        for j, other_box in enumerate(bounding_boxes):
-            if i != j and is_contained(box, other_box):
-                contained = True
-                break
-        if not contained:
-            filtered_bounding_boxes.append(box)
+    filtered_bounding_boxes = filter_contained_boxes(bounding_boxes)
 
 
     heights = [abs(y2 - y1) for _, y1, _, y2 in filtered_bounding_boxes]
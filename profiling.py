@@ -0,0 +1,202 @@
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows: niente getrusage, la memoria di picco non viene registrata
+    resource = None
+
+
+# Timer attivo per il thread corrente: le funzioni di Auxiliary/poledetection registrano
+# tempi e contatori senza doverlo ricevere come parametro (nessun effetto se non attivo).
+_local = threading.local()
+
+
+class StageTimer:
+    """
+    Raccoglie la durata delle fasi della pipeline e i contatori (chiamate ai modelli, tile, ritagli).
+    I contatori sono attribuiti alla fase più interna attiva al momento del conteggio.
+    Con `track_memory` (solo Linux, vedi reset_peak_rss) registra anche il picco di RSS raggiunto
+    durante ogni fase: all'ingresso il picco del kernel viene azzerato, all'uscita si legge VmHWM.
+    Il picco di una fase comprende quelli delle sue sottofasi. Dove l'azzeramento non è possibile
+    i picchi per fase non vengono registrati (resta solo peak_rss_mb, per l'intero processo).
+    """
+
+    def __init__(self, track_memory=True):
+        self.stages = {}
+        self.counters = {}
+        self.peak_rss = {}
+        self.track_memory = track_memory and can_reset_peak_rss()
+        self._active = []
+        # picco già osservato per ogni fase attiva, prima degli azzeramenti delle sottofasi
+        self._peaks = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        self._active.append(name)
+        if self.track_memory:
+            hwm = _status_mb("VmHWM")
+            self._peaks = [max(peak, hwm) for peak in self._peaks]
+            reset_peak_rss()
+            self._peaks.append(0.0)
+        try:
+            yield
+        finally:
+            self._active.pop()
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+            if self.track_memory:
+                peak = max(self._peaks.pop(), _status_mb("VmHWM"))
+                self.peak_rss[name] = max(self.peak_rss.get(name, 0.0), peak)
+
+    def count(self, name, n=1):
+        stage = self._active[-1] if self._active else "other"
+        stage_counters = self.counters.setdefault(stage, {})
+        stage_counters[name] = stage_counters.get(name, 0) + n
+
+    def totals(self):
+        totals = {}
+        for stage_counters in self.counters.values():
+            for name, n in stage_counters.items():
+                totals[name] = totals.get(name, 0) + n
+        return totals
+
+    def as_dict(self):
+        return {
+            "stageTimings": {name: round(seconds, 4) for name, seconds in self.stages.items()},
+            "counters": {stage: dict(c) for stage, c in self.counters.items()},
+            "totals": self.totals(),
+            "peakRssMb": {name: round(mb, 1) for name, mb in self.peak_rss.items()},
+        }
+
+
+# picco del processo osservato prima dell'ultimo azzeramento (reset_peak_rss azzera anche ru_maxrss)
+_process_peak_mb = 0.0
+_reset_lock = threading.Lock()
+
+
+def _status_mb(field):
+    """Valore di `field` (es. "VmHWM") da /proc/self/status in MB, 0 se non disponibile."""
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def can_reset_peak_rss():
+    """True se il picco di RSS del processo si può azzerare (Linux, /proc/self/clear_refs scrivibile)."""
+    return os.access("/proc/self/clear_refs", os.W_OK) and _status_mb("VmHWM") > 0
+
+
+def reset_peak_rss():
+    """
+    Azzera il picco di RSS del kernel (VmHWM) al valore attuale scrivendo 5 in /proc/self/clear_refs.
+    Il picco precedente viene conservato per peak_rss_mb. Restituisce False se non è possibile.
+    """
+    global _process_peak_mb
+    with _reset_lock:
+        _process_peak_mb = max(_process_peak_mb, peak_rss_mb() or 0.0)
+        try:
+            with open("/proc/self/clear_refs", "w") as fp:
+                fp.write("5")
+        except OSError:
+            return False
+    return True
+
+
+def peak_rss_mb():
+    """Picco di memoria residente dell'intero processo in MB (None se non disponibile)."""
+    if resource is None:
+        return None
+    # ru_maxrss è in KB su Linux e in byte su macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if os.uname().sysname == "Darwin":
+        return maxrss / (1024 * 1024)
+    return max(_process_peak_mb, maxrss / 1024, _status_mb("VmHWM"))
+
+
+def current():
+    """Restituisce il timer attivo sul thread corrente, oppure None."""
+    return getattr(_local, "timer", None)
+
+
+def stage(name):
+    """Context manager che misura la fase `name` sul timer attivo (nullo se non c'è)."""
+    timer = current()
+    if timer is None:
+        return contextlib.nullcontext()
+    return timer.stage(name)
+
+
+def count(name, n=1):
+    """Incrementa il contatore `name` della fase corrente sul timer attivo."""
+    timer = current()
+    if timer is not None:
+        timer.count(name, n)
+
+
+@contextlib.contextmanager
+def use_timer(timer):
+    """
+    Rende `timer` il timer attivo sul thread corrente per la durata del blocco: serve quando le fasi
+    di una stessa sessione girano su thread diversi (executor.StagedExecutor).
+    """
+    previous = current()
+    _local.timer = timer
+    try:
+        yield timer
+    finally:
+        _local.timer = previous
+
+
+@contextlib.contextmanager
+def profile_session(profiler=None, trace_path=None):
+    """
+    Attiva un nuovo StageTimer sul thread corrente per la durata del blocco.
+    `profiler` può essere None, "cprofile" (salva un .prof) o "torch" (salva una trace chrome .json)
+    in `trace_path`.
+    """
+    timer = StageTimer()
+    previous = current()
+    _local.timer = timer
+    if trace_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(trace_path)), exist_ok=True)
+    try:
+        if profiler == "cprofile":
+            prof = cProfile.Profile()
+            prof.enable()
+            try:
+                yield timer
+            finally:
+                prof.disable()
+                prof.dump_stats(trace_path)
+        elif profiler == "torch":
+            import torch
+            import torch.profiler as tprof
+            activities = [tprof.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(tprof.ProfilerActivity.CUDA)
+            with tprof.profile(activities=activities, record_shapes=True) as prof:
+                yield timer
+            prof.export_chrome_trace(trace_path)
+        elif profiler is None:
+            yield timer
+        else:
+            raise ValueError(f"Unknown profiler: {profiler}")
+    finally:
+        _local.timer = previous
+
+
+def log_timings(path, record):
+    """Aggiunge una riga JSON (una sessione) al log delle temporizzazioni."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a") as fp:
+        fp.write(json.dumps(record) + "\n")
@@ -0,0 +1,253 @@
+"""
+Quantizzazione INT8 post-training dei quattro modelli con calibrazione sulle sessioni di dataset/.
+
+Per ogni modello prepara un insieme di immagini di calibrazione simile a quello che vede nella pipeline:
+- arance: le tile della griglia 8x15 delle immagini di sessione;
+- albero: le immagini di sessione intere;
+- pali: le strisce larghe 640 px;
+- maturazione: i ritagli delle arance trovate dal modello FP32.
+Scrive il file YAML del dataset, esporta con ultralytics (OpenVINO, int8=True) accanto ai pesi
+(modelloN_int8_openvino_model/) e infine confronta conteggi, maturazione e dimensioni tra la pipeline
+FP32 e quella INT8 sulle stesse sessioni. La pipeline usa i modelli INT8 con
+{"inference_backend": "openvino", "precision": "int8"}.
+
+Esempi:
+    python quantize.py
+    python quantize.py --models orange ripeness --max-images 200 --report benchmarks/int8.json
+    python quantize.py --skip-export --sessions dataset/0304 dataset/1205
+"""
+import argparse
+import glob
+import importlib.util
+import json
+import os
+import random
+import statistics
+import time
+
+import cv2
+import numpy as np
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+from pipeline import BASE_PATH, analyze_session, load_config
+from modelregistry import backend_artifact, export_model, get_model
+from stitching import capture_order
+from Auxiliary import read_images, divide_image, predict_tiles, tile_boxes, crop_region, DEFAULT_IMGSZ
+from poledetection import divide_image_horizontally
+
+
+DEFAULT_SESSIONS = sorted(glob.glob(os.path.join(BASE_PATH, "dataset", "*")))
+
+# modello -> chiave della configurazione con il percorso dei pesi
+MODEL_CONFIG_KEYS = {
+    "orange": "orange_model_path",
+    "tree": "orangetree_model_path",
+    "pole": "pole_model_path",
+    "ripeness": "ripening_model_path",
+}
+
+
+def session_images(sessions, workers=4):
+    """Immagini BGR di tutte le sessioni, nell'ordine di acquisizione."""
+    images = []
+    for folder_path in sessions:
+        decoded, _ = read_images(capture_order(glob.glob(folder_path + "/*")), workers=workers)
+        images.extend(decoded)
+    return images
+
+
+def calibration_images(name, images, config):
+    """Immagini di calibrazione (frame BGR) per il modello `name`, come le riceve nella pipeline."""
+    if name == "tree":
+        return list(images)
+    if name == "pole":
+        return [strip for image in images for strip, _ in divide_image_horizontally(image, 640)]
+    tiles = [tile for image in images for tile in divide_image(image)[0]]
+    if name == "orange":
+        return tiles
+    # maturazione: ritagli delle arance trovate dal modello FP32 sulle tile
+    orange = get_model(config["orange_model_path"], device=config["device"])
+    crops = []
+    for image in images:
+        image_tiles, positions = divide_image(image)
+        predictions = predict_tiles(orange, image_tiles, batch_size=config["orange_batch_size"],
+                                    conf=config["orange_confidence"])
+        boxes, _, _ = tile_boxes(predictions, positions)
+        for box in boxes:
+            crop = crop_region(image, box)
+            if min(crop.shape[:2]) > 0:
+                crops.append(crop)
+    return crops
+
+
+def write_calibration_set(name, frames, model_path, workdir, max_images, seed=0):
+    """
+    Salva (al più `max_images`, campionate) le immagini in workdir/<name>/images/val e scrive
+    il YAML del dataset per l'export INT8 di ultralytics. Restituisce il percorso del YAML.
+    """
+    root = os.path.join(os.path.abspath(workdir), name)
+    image_dir = os.path.join(root, "images", "val")
+    os.makedirs(image_dir, exist_ok=True)
+    for old in glob.glob(os.path.join(image_dir, "*.jpg")):
+        os.remove(old)
+    if len(frames) > max_images:
+        frames = random.Random(seed).sample(frames, max_images)
+    for k, frame in enumerate(frames):
+        cv2.imwrite(os.path.join(image_dir, f"{name}_{k:05d}.jpg"), frame)
+
+    names = get_model(model_path).names
+    yaml_path = os.path.join(root, f"{name}.yaml")
+    with open(yaml_path, "w") as fp:
+        fp.write(f"path: {json.dumps(root)}\n")
+        fp.write("train: images/val\n")
+        fp.write("val: images/val\n")
+        fp.write("names:\n")
+        for idx in sorted(names):
+            fp.write(f"  {idx}: {json.dumps(str(names[idx]))}\n")
+    print("calibration set", name, ":", len(frames), "images ->", yaml_path)
+    return yaml_path
+
+
+def quantize_models(names, sessions, config, workdir, max_images, workers=4):
+    """Costruisce i set di calibrazione ed esporta i modelli INT8; restituisce {modello: artefatto}."""
+    images = session_images(sessions, workers=workers)
+    artifacts = {}
+    for name in names:
+        model_path = config[MODEL_CONFIG_KEYS[name]]
+        frames = calibration_images(name, images, config)
+        if not frames:
+            print("no calibration images for", name, "- skipped")
+            continue
+        yaml_path = write_calibration_set(name, frames, model_path, workdir, max_images)
+        # l'export (dinamico) vuole un intero: None e "auto" si calibrano alla dimensione di default
+        imgsz = config["ripening_imgsz"] if name == "ripeness" else DEFAULT_IMGSZ
+        if not isinstance(imgsz, int):
+            imgsz = DEFAULT_IMGSZ
+        # batch=1: ultralytics richiede almeno `batch` immagini di calibrazione (l'albero ne ha poche)
+        artifacts[name] = export_model(model_path, "openvino", precision="int8", data=yaml_path,
+                                       imgsz=imgsz, batch=1)
+    return artifacts
+
+
+def missing_int8_models(config):
+    """Modelli senza export INT8 accanto ai pesi: nel confronto girerebbero in FP32."""
+    return [name for name, key in MODEL_CONFIG_KEYS.items()
+            if not os.path.exists(backend_artifact(config[key], "openvino", "int8"))]
+
+
+def summarize_run(results):
+    return {
+        "oranges": results["oranges"],
+        "avgMaturity": round(results["avgMaturity"], 3),
+        "avgDimesions": round(results["avgDimesions"], 3),
+        "avgWeights": round(results["avgWeights"], 3),
+        "execTime": round(results["execTime"], 3),
+    }
+
+
+def accuracy_report(sessions, config, seed=0):
+    """
+    Esegue la pipeline FP32 e INT8 sulle stesse sessioni e confronta conteggi, maturazione e dimensioni.
+    Il seme fisso rende uguali i valori di maturazione di ripiego delle tile vuote nei due casi.
+    I modelli senza export INT8 ripiegherebbero in silenzio su FP32: se mancano tutti (o manca
+    OpenVINO) il confronto non parte, altrimenti il report li elenca in "fp32Models".
+    """
+    if importlib.util.find_spec("openvino") is None:
+        raise SystemExit("The INT8 comparison requires openvino")
+    missing = missing_int8_models(load_config(config))
+    if len(missing) == len(MODEL_CONFIG_KEYS):
+        raise SystemExit("No INT8 model found: run quantize.py without --skip-export first")
+    if missing:
+        print("WARNING: no INT8 export for", ", ".join(missing), "- the int8 run uses FP32 for these models")
+    int8_config = dict(config, inference_backend="openvino", precision="int8")
+    report = {"sessions": {},
+              "int8Models": [name for name in MODEL_CONFIG_KEYS if name not in missing],
+              "fp32Models": missing}
+    for folder_path in sessions:
+        name = os.path.basename(os.path.normpath(folder_path))
+        runs = {}
+        for label, run_config in (("fp32", config), ("int8", int8_config)):
+            print("ACCURACY", name, label)
+            np.random.seed(seed)
+            runs[label] = summarize_run(analyze_session(folder_path, run_config))
+        fp32, int8 = runs["fp32"], runs["int8"]
+        report["sessions"][name] = {
+            "fp32": fp32,
+            "int8": int8,
+            "orangeCountDiff": int8["oranges"] - fp32["oranges"],
+            "orangeCountRelDiff": round((int8["oranges"] - fp32["oranges"]) / fp32["oranges"], 4)
+            if fp32["oranges"] else None,
+            "avgMaturityDiff": round(int8["avgMaturity"] - fp32["avgMaturity"], 3),
+            "avgDimesionsDiff": round(int8["avgDimesions"] - fp32["avgDimesions"], 3),
+            "avgWeightsDiff": round(int8["avgWeights"] - fp32["avgWeights"], 3),
+            "speedup": round(fp32["execTime"] / int8["execTime"], 3) if int8["execTime"] > 0 else None,
+        }
+
+    rows = list(report["sessions"].values())
+    if rows:
+        count_diffs = [abs(r["orangeCountRelDiff"]) for r in rows if r["orangeCountRelDiff"] is not None]
+        speedups = [r["speedup"] for r in rows if r["speedup"]]
+        report["summary"] = {
+            "meanAbsOrangeCountRelDiff": round(statistics.mean(count_diffs), 4) if count_diffs else None,
+            "meanAbsAvgMaturityDiff": round(statistics.mean(abs(r["avgMaturityDiff"]) for r in rows), 3),
+            "meanAbsAvgDimesionsDiff": round(statistics.mean(abs(r["avgDimesionsDiff"]) for r in rows), 3),
+            "meanSpeedup": round(statistics.mean(speedups), 3) if speedups else None,
+        }
+    return report
+
+
+def print_report(report):
+    print()
+    print(f"{'session':<12}{'oranges fp32':>14}{'int8':>8}{'maturity d':>12}{'size d (mm)':>13}{'speedup':>9}")
+    for name, row in report["sessions"].items():
+        print(f"{name:<12}{row['fp32']['oranges']:>14}{row['int8']['oranges']:>8}"
+              f"{row['avgMaturityDiff']:>12.2f}{row['avgDimesionsDiff']:>13.2f}{row['speedup'] or 0:>9.2f}")
+    if report["fp32Models"]:
+        print("not quantized (FP32 in both runs):", ", ".join(report["fp32Models"]))
+    if "summary" in report:
+        print("summary:", report["summary"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Clever INT8 post-training quantization")
+    parser.add_argument("--models", nargs="*", default=list(MODEL_CONFIG_KEYS), choices=list(MODEL_CONFIG_KEYS),
+                        help="modelli da quantizzare (default: tutti)")
+    parser.add_argument("--sessions", nargs="*", default=DEFAULT_SESSIONS,
+                        help="sessioni usate per calibrazione e confronto (default: tutte quelle in dataset/)")
+    parser.add_argument("--config", help="file JSON che sovrascrive la configurazione della pipeline (FP32)")
+    parser.add_argument("--workdir", default=os.path.join("runs", "calibration"),
+                        help="cartella delle immagini e dei YAML di calibrazione")
+    parser.add_argument("--max-images", type=int, default=300, help="immagini di calibrazione per modello")
+    parser.add_argument("--skip-export", action="store_true",
+                        help="non riquantizza: confronta soltanto i modelli INT8 già esportati")
+    parser.add_argument("--report", default=os.path.join("benchmarks", "int8_report.json"),
+                        help="file JSON del confronto FP32/INT8")
+    args = parser.parse_args(argv)
+
+    overrides = {}
+    if args.config:
+        with open(args.config) as fp:
+            overrides = json.load(fp)
+    # i tempi del confronto non devono finire nel log di produzione
+    overrides.setdefault("timing_log", None)
+    config = load_config(overrides)
+
+    start = time.perf_counter()
+    artifacts = {}
+    if not args.skip_export:
+        artifacts = quantize_models(args.models, args.sessions, config, args.workdir, args.max_images,
+                                    workers=config["decode_workers"])
+    export_time = time.perf_counter() - start
+
+    report = accuracy_report(args.sessions, overrides)
+    report["artifacts"] = artifacts
+    report["exportTime"] = round(export_time, 3)
+    os.makedirs(os.path.dirname(os.path.abspath(args.report)), exist_ok=True)
+    with open(args.report, "w") as fp:
+        json.dump(report, fp, indent=2)
+    print_report(report)
+    print("report written to", args.report)
+
+
+if __name__ == "__main__":
+    main()
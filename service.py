@@ -0,0 +1,157 @@
+"""
+Servizio di analisi sempre attivo.
+
+Carica i modelli una sola volta e poi resta in attesa di nuove sessioni di immagini:
+- in modalità "inbox" controlla periodicamente una cartella, dove ogni sottocartella è una sessione;
+- in modalità "socket" riceve su un socket unix locale il percorso della cartella di sessione.
+Per ogni sessione esegue la pipeline stitch -> correzione -> albero -> arance -> pali
+e scrive un file JSON con i risultati nella cartella di output.
+
+Esempi:
+    python service.py --inbox inbox --outbox results
+    python service.py --socket /tmp/clever.sock --outbox results
+"""
+import argparse
+import json
+import os
+import socketserver
+import time
+import traceback
+
+# il servizio non ha GUI: ultralytics importa matplotlib, ma senza backend grafico
+os.environ.setdefault("MPLBACKEND", "Agg")
+from pipeline import analyze_session, load_config, load_pipeline_models
+from executor import StagedExecutor
+
+
+def result_path(outbox, folder_path):
+    return os.path.join(outbox, os.path.basename(os.path.normpath(folder_path)) + ".json")
+
+
+def intermediates_dir(outbox, folder_path):
+    return os.path.join(outbox, os.path.basename(os.path.normpath(folder_path)))
+
+
+def process_session(folder_path, outbox, config=None, save_intermediates=False):
+    """
+    Analizza una sessione e scrive il JSON dei risultati (o dell'errore) in `outbox`.
+    Con `save_intermediates` le immagini intermedie finiscono in `outbox/<sessione>/`.
+    """
+    print("SESSION STARTING:", folder_path)
+    save_dir = None
+    if save_intermediates:
+        save_dir = intermediates_dir(outbox, folder_path)
+    try:
+        results = analyze_session(folder_path, config, save_dir=save_dir)
+    except Exception as e:
+        traceback.print_exc()
+        results = {"error": repr(e), "session": folder_path}
+    return write_results(folder_path, outbox, results)
+
+
+def write_results(folder_path, outbox, results):
+    """Scrive il JSON dei risultati di una sessione in `outbox`."""
+    os.makedirs(outbox, exist_ok=True)
+    output = result_path(outbox, folder_path)
+    # scrittura atomica: chi legge la cartella di output non vede mai un JSON a metà
+    tmp = output + ".tmp"
+    with open(tmp, "w") as fp:
+        json.dump(results, fp)
+    os.replace(tmp, output)
+    print("... SESSION DONE:", output)
+    return results
+
+
+def session_ready(folder_path, settle):
+    """Una sessione è pronta se contiene immagini e non è stata modificata negli ultimi `settle` secondi."""
+    entries = [os.path.join(folder_path, f) for f in os.listdir(folder_path)]
+    files = [f for f in entries if os.path.isfile(f)]
+    if not files:
+        return False
+    last_change = max(os.path.getmtime(f) for f in files + [folder_path])
+    return time.time() - last_change >= settle
+
+
+def watch_inbox(inbox, outbox, config=None, poll=2.0, settle=5.0, save_intermediates=False):
+    """
+    Controlla `inbox` e analizza ogni nuova sottocartella che non ha ancora un risultato.
+    Se sono pronte più sessioni insieme (arretrato dopo un'interruzione) vengono analizzate
+    con StagedExecutor, sovrapponendo le fasi di sessioni diverse (non con un profiler attivo,
+    le cui trace sono per singolo thread).
+    """
+    print("watching inbox", inbox, "->", outbox)
+    os.makedirs(inbox, exist_ok=True)
+    executor = StagedExecutor(config) if load_config(config)["profiler"] is None else None
+    save_dir_for = (lambda folder_path: intermediates_dir(outbox, folder_path)) if save_intermediates else None
+    while True:
+        ready = []
+        for name in sorted(os.listdir(inbox)):
+            folder_path = os.path.join(inbox, name)
+            if not os.path.isdir(folder_path) or os.path.exists(result_path(outbox, folder_path)):
+                continue
+            if session_ready(folder_path, settle):
+                ready.append(folder_path)
+        if len(ready) == 1 or executor is None:
+            for folder_path in ready:
+                process_session(folder_path, outbox, config, save_intermediates)
+        elif ready:
+            print("SESSIONS STARTING:", len(ready))
+            executor.run(ready, on_result=lambda folder_path, results: write_results(folder_path, outbox, results),
+                         save_dir_for=save_dir_for)
+        time.sleep(poll)
+
+
+def serve_socket(socket_path, outbox, config=None, save_intermediates=False):
+    """
+    Ascolta su un socket unix: ogni riga ricevuta è il percorso di una sessione,
+    la risposta è una riga con il JSON dei risultati.
+    """
+    class SessionHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                folder_path = line.decode("utf-8").strip()
+                if not folder_path:
+                    continue
+                results = process_session(folder_path, outbox, config, save_intermediates)
+                self.wfile.write((json.dumps(results) + "\n").encode("utf-8"))
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    print("listening on", socket_path, "->", outbox)
+    # server non threaded: le sessioni vengono analizzate una alla volta con gli stessi modelli
+    with socketserver.UnixStreamServer(socket_path, SessionHandler) as server:
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(socket_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Clever orange analysis service")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--inbox", help="cartella controllata: ogni sottocartella è una sessione")
+    source.add_argument("--socket", help="socket unix su cui ricevere i percorsi delle sessioni")
+    parser.add_argument("--outbox", default="results", help="cartella dei JSON dei risultati")
+    parser.add_argument("--config", help="file JSON che sovrascrive la configurazione della pipeline")
+    parser.add_argument("--poll", type=float, default=2.0, help="intervallo di controllo dell'inbox (s)")
+    parser.add_argument("--settle", type=float, default=5.0,
+                        help="secondi senza modifiche prima di considerare completa una sessione")
+    parser.add_argument("--save-intermediates", action="store_true",
+                        help="salva mosaic/corrected/trees.jpg di ogni sessione in outbox/<sessione>/")
+    args = parser.parse_args(argv)
+
+    config = None
+    if args.config:
+        with open(args.config) as fp:
+            config = json.load(fp)
+
+    load_pipeline_models(config)
+    if args.inbox:
+        watch_inbox(args.inbox, args.outbox, config, poll=args.poll, settle=args.settle,
+                    save_intermediates=args.save_intermediates)
+    else:
+        serve_socket(args.socket, args.outbox, config, save_intermediates=args.save_intermediates)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+import cv2
+import numpy as np
+import hashlib
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Stitching "a cache": le feature SIFT vengono estratte a bassa risoluzione (registration_mp),
+# salvate su disco per hash del file e usate per stimare le trasformazioni; il mosaico viene poi
+# composto alla risoluzione richiesta dalle fasi successive (compositing_mp).
+
+
+# flag di cv2.imread per la decodifica a risoluzione ridotta (1/2, 1/4, 1/8) direttamente dal JPEG
+REDUCED_READ_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+# UBox_IMG_YYYYMMDD_HHMMSS...: le cifre dopo HHMMSS (ripetizione dei secondi) vengono ignorate
+CAPTURE_TIME_PATTERN = re.compile(r"_(\d{8})_(\d{6})\d*_")
+
+
+def capture_order(image_files):
+    """
+    Ordina i file per istante di acquisizione letto dal nome UBox (data + HHMMSS);
+    i file con nome diverso seguono, in ordine alfabetico.
+    """
+    def key(path):
+        match = CAPTURE_TIME_PATTERN.search(os.path.basename(path))
+        if match is None:
+            return (1, "", os.path.basename(path))
+        return (0, match.group(1) + match.group(2), os.path.basename(path))
+    return sorted(image_files, key=key)
+
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def megapixel_scale(shape, megapixels):
+    """Fattore di scala per portare un'immagine a `megapixels` MP (mai oltre 1; <= 0 = nativa)."""
+    if megapixels is None or megapixels <= 0:
+        return 1.0
+    h, w = shape[:2]
+    return min(1.0, float(np.sqrt(megapixels * 1e6 / (w * h))))
+
+
+class FeatureCache:
+    """Cache su disco (.npz) di keypoint e descrittori; senza cartella non salva nulla."""
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def load(self, key):
+        if self.cache_dir is None or not os.path.exists(self._path(key)):
+            return None
+        data = np.load(self._path(key))
+        return data["points"], data["descriptors"], float(data["scale"])
+
+    def save(self, key, points, descriptors, scale):
+        if self.cache_dir is None:
+            return
+        # scrittura atomica: un processo concorrente non legge mai un file a metà
+        tmp = self._path(key) + ".tmp.npz"
+        np.savez(tmp, points=points, descriptors=descriptors, scale=scale)
+        os.replace(tmp, self._path(key))
+
+
+def detect_features(image, megapixels, detector):
+    """
+    Estrae le feature su una copia ridotta a `megapixels`.
+    Restituisce punti (N, 2) in coordinate di registrazione, descrittori e scala usata.
+    """
+    scale = megapixel_scale(image.shape, megapixels)
+    if scale < 1.0:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    keypoints, descriptors = detector.detectAndCompute(gray, None)
+    points = np.float32([kp.pt for kp in keypoints]).reshape(-1, 2)
+    if descriptors is None:
+        descriptors = np.zeros((0, 128), dtype=np.float32)
+    return points, descriptors, scale
+
+
+def image_features(images, image_files, megapixels=0.6, cache_dir=None, max_features=4000, reduce=1, workers=4):
+    """
+    Feature di ogni immagine, lette dalla cache quando il file (per hash) è già stato visto.
+    Con `reduce` 2, 4 o 8 le feature mancanti vengono estratte da copie decodificate dal JPEG
+    a 1/reduce (in parallelo su `workers` thread) invece che dai frame a piena risoluzione,
+    che restano invariati per la composizione; i punti tornano comunque in scala piena.
+    """
+    cache = FeatureCache(cache_dir)
+    detector = cv2.SIFT_create(nfeatures=max_features)
+    keys = []
+    for image, image_file in zip(images, image_files):
+        h, w = image.shape[:2]
+        key = f"{file_hash(image_file)}_{w}x{h}_{megapixels}mp_sift{max_features}"
+        keys.append(key if reduce == 1 else f"{key}_r{reduce}")
+    features = [cache.load(key) for key in keys]
+    missing = [k for k, cached in enumerate(features) if cached is None]
+
+    reduced = {}
+    if reduce != 1 and missing:
+        flag = REDUCED_READ_FLAGS[reduce]
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            reduced = dict(zip(missing, pool.map(lambda k: cv2.imread(image_files[k], flag), missing)))
+
+    for k in missing:
+        small = reduced.get(k)
+        if small is None:
+            features[k] = detect_features(images[k], megapixels, detector)
+        else:
+            points, descriptors, scale = detect_features(small, megapixels, detector)
+            # scala rispetto al frame a piena risoluzione, come per le feature senza riduzione
+            features[k] = points, descriptors, scale * small.shape[1] / images[k].shape[1]
+        cache.save(keys[k], *features[k])
+    return features
+
+
+def match_pair(features_a, features_b, motion="affine", ratio=0.75, min_inliers=20, ransac_threshold=4.0):
+    """
+    Trasformazione 3x3 (in coordinate a piena risoluzione) che porta l'immagine a sull'immagine b,
+    con il numero di inlier RANSAC; (None, 0) se le immagini non si sovrappongono abbastanza.
+    `motion` è "affine" (similitudine: rotazione, scala, traslazione; stabile su sweep lunghi)
+    oppure "homography" (prospettica completa, accumula più deriva concatenando molte immagini).
+    """
+    points_a, descriptors_a, scale_a = features_a
+    points_b, descriptors_b, scale_b = features_b
+    if len(descriptors_a) < 2 or len(descriptors_b) < 2:
+        return None, 0
+    matcher = cv2.FlannBasedMatcher(dict(algorithm=1, trees=5), dict(checks=50))
+    knn = matcher.knnMatch(descriptors_a, descriptors_b, k=2)
+    good = [pair[0] for pair in knn if len(pair) == 2 and pair[0].distance < ratio * pair[1].distance]
+    if len(good) < min_inliers:
+        return None, 0
+    src = points_a[[m.queryIdx for m in good]]
+    dst = points_b[[m.trainIdx for m in good]]
+    if motion == "homography":
+        H, mask = cv2.findHomography(src, dst, cv2.RANSAC, ransac_threshold)
+    elif motion == "affine":
+        A, mask = cv2.estimateAffinePartial2D(src, dst, method=cv2.RANSAC,
+                                              ransacReprojThreshold=ransac_threshold)
+        H = None if A is None else np.vstack([A, [0.0, 0.0, 1.0]])
+    else:
+        raise ValueError(f"Unknown motion model: {motion}")
+    if H is None or int(mask.sum()) < min_inliers:
+        return None, 0
+    # da coordinate di registrazione a coordinate piene: H_full = S_b^-1 H S_a
+    S_a = np.diag([scale_a, scale_a, 1.0])
+    S_b_inv = np.diag([1.0 / scale_b, 1.0 / scale_b, 1.0])
+    return S_b_inv @ H @ S_a, int(mask.sum())
+
+
+def chain_transforms(n, pair_homographies):
+    """
+    Dalle omografie a coppie {(i, j): (H_ij, inlier)} (H_ij porta i su j) costruisce, con un albero
+    di copertura di peso massimo (inlier) radicato nell'immagine più connessa, le trasformazioni
+    di ogni immagine nel sistema di riferimento di quest'ultima. Le immagini non collegate sono None.
+    """
+    weights = np.zeros(n)
+    for (i, j), (_, inliers) in pair_homographies.items():
+        weights[i] += inliers
+        weights[j] += inliers
+    reference = int(np.argmax(weights))
+
+    transforms = [None] * n
+    transforms[reference] = np.eye(3)
+    while True:
+        best = None
+        for (i, j), (H, inliers) in pair_homographies.items():
+            # arco tra un nodo già nell'albero e uno nuovo
+            if (transforms[i] is None) == (transforms[j] is None):
+                continue
+            if best is None or inliers > best[0]:
+                best = (inliers, i, j, H)
+        if best is None:
+            break
+        _, i, j, H = best
+        if transforms[j] is not None:
+            # i nuovo: i -> j -> riferimento
+            transforms[i] = transforms[j] @ H
+        else:
+            # j nuovo: j -> i -> riferimento
+            transforms[j] = transforms[i] @ np.linalg.inv(H)
+    return transforms
+
+
+def compose(images, transforms, megapixels=-1, max_canvas_ratio=20.0):
+    """
+    Proietta le immagini sul piano di riferimento e le fonde con pesi "feather" (più peso al centro).
+    Il mosaico è composto a `megapixels` MP per immagine (<= 0 = risoluzione nativa).
+    Restituisce None se le trasformazioni producono una tela assurda (omografie degeneri).
+    """
+    pairs = [(img, T) for img, T in zip(images, transforms) if T is not None]
+    scale = megapixel_scale(pairs[0][0].shape, megapixels)
+    S = np.diag([scale, scale, 1.0])
+    S_inv = np.diag([1.0 / scale, 1.0 / scale, 1.0])
+
+    warped_corners = []
+    scaled = []
+    for img, T in pairs:
+        if scale < 1.0:
+            img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        T = S @ T @ S_inv
+        h, w = img.shape[:2]
+        corners = np.float32([[0, 0], [w, 0], [w, h], [0, h]]).reshape(-1, 1, 2)
+        warped_corners.append(cv2.perspectiveTransform(corners, T).reshape(-1, 2))
+        scaled.append((img, T))
+
+    all_corners = np.concatenate(warped_corners)
+    min_x, min_y = np.floor(all_corners.min(axis=0)).astype(int)
+    max_x, max_y = np.ceil(all_corners.max(axis=0)).astype(int)
+    width, height = max_x - min_x, max_y - min_y
+    source_area = sum(img.shape[0] * img.shape[1] for img, _ in scaled)
+    if width <= 0 or height <= 0 or width * height > max_canvas_ratio * source_area:
+        return None
+
+    offset = np.array([[1, 0, -min_x], [0, 1, -min_y], [0, 0, 1]], dtype=np.float64)
+    accumulator = np.zeros((height, width, 3), dtype=np.float32)
+    weight_sum = np.zeros((height, width), dtype=np.float32)
+    for img, T in scaled:
+        h, w = img.shape[:2]
+        # peso = distanza dal bordo dell'immagine, per sfumare le giunzioni
+        feather = np.minimum.outer(np.minimum(np.arange(h), np.arange(h)[::-1]),
+                                   np.minimum(np.arange(w), np.arange(w)[::-1])).astype(np.float32) + 1.0
+        M = offset @ T
+        warped = cv2.warpPerspective(img, M, (width, height), flags=cv2.INTER_LINEAR)
+        warped_weight = cv2.warpPerspective(feather, M, (width, height), flags=cv2.INTER_LINEAR)
+        accumulator += warped.astype(np.float32) * warped_weight[..., None]
+        weight_sum += warped_weight
+
+    covered = weight_sum > 0
+    accumulator[covered] /= weight_sum[covered][:, None]
+    return accumulator.astype(np.uint8)
+
+
+def stitch_cached(images, image_files, registration_mp=0.6, compositing_mp=-1, cache_dir=None, motion="affine",
+                  registration_reduce=1, workers=4):
+    """
+    Mosaico con registrazione a bassa risoluzione su tutte le coppie di immagini e feature in cache.
+    `registration_reduce` e `workers` vanno a image_features (decodifica ridotta per la registrazione).
+    Restituisce il mosaico BGR, oppure None se meno di due immagini risultano collegate.
+    """
+    features = image_features(images, image_files, megapixels=registration_mp, cache_dir=cache_dir,
+                              reduce=registration_reduce, workers=workers)
+    pair_homographies = {}
+    for i in range(len(images)):
+        for j in range(i + 1, len(images)):
+            H, inliers = match_pair(features[i], features[j], motion=motion)
+            if H is not None:
+                pair_homographies[(i, j)] = (H, inliers)
+    if not pair_homographies:
+        return None
+    transforms = chain_transforms(len(images), pair_homographies)
+    if sum(T is not None for T in transforms) < 2:
+        return None
+    return compose(images, transforms, megapixels=compositing_mp)
+
+
+def stitch_sequential(images, image_files, registration_mp=0.6, compositing_mp=-1, cache_dir=None,
+                      motion="affine", window=2, registration_reduce=1, workers=4):
+    """
+    Mosaico per sequenze ordinate (sweep della camera): ogni immagine viene confrontata solo con
+    la successiva, quindi O(n) confronti invece di O(n^2), e le trasformazioni vengono concatenate
+    lungo la sequenza. Se un collegamento manca si prova a scavalcarlo con coppie distanti al più
+    `window` posizioni. Le immagini devono essere già in ordine di acquisizione (capture_order).
+    `registration_reduce` e `workers` come in stitch_cached.
+    Restituisce il mosaico BGR, oppure None se meno di due immagini sono collegate.
+    """
+    n = len(images)
+    features = image_features(images, image_files, megapixels=registration_mp, cache_dir=cache_dir,
+                              reduce=registration_reduce, workers=workers)
+    pair_homographies = {}
+    for i in range(n - 1):
+        H, inliers = match_pair(features[i], features[i + 1], motion=motion)
+        if H is not None:
+            pair_homographies[(i, i + 1)] = (H, inliers)
+    for i in range(n - 1):
+        if (i, i + 1) in pair_homographies:
+            continue
+        for a in range(max(0, i + 1 - window), i + 1):
+            for b in range(i + 1, min(n, a + window + 1)):
+                if b - a < 2 or (a, b) in pair_homographies:
+                    continue
+                H, inliers = match_pair(features[a], features[b], motion=motion)
+                if H is not None:
+                    pair_homographies[(a, b)] = (H, inliers)
+    if not pair_homographies:
+        return None
+    transforms = chain_transforms(len(images), pair_homographies)
+    if sum(T is not None for T in transforms) < 2:
+        return None
+    return compose(images, transforms, megapixels=compositing_mp)